@@ -0,0 +1,74 @@
+import timeit
+import tracemalloc
+
+from src.event import Event
+
+NUMBER_OF_EVENTS = 10000
+REPEAT = 5
+
+JSON_OBJECT = {
+    'eventId': 'a1b2c3d4-0000-4000-8000-000000000000',
+    'eventType': 'session_event',
+    'timestamp': 1518264452000,
+    'originatingService': 'https://www.signin.service.gov.uk/SAML2/metadata/federation',
+    'sessionId': 'e5f6a7b8-0000-4000-8000-000000000000',
+    'details': {'session_event_type': 'idp_authn_succeeded'},
+}
+
+
+class PropertyEvent(object):
+    """
+    The previous representation of an event, kept here for comparison.
+    """
+
+    def __init__(self, event_id, timestamp, event_type, originating_service, session_id, details, raw_json=None,
+                 details_path=()):
+        self.__event_id = event_id
+        self.__timestamp = timestamp
+        self.__originating_service = originating_service
+        self.__session_id = session_id
+        self.__event_type = event_type
+        self.__details = details
+        self.__raw_json = raw_json
+        self.__details_path = details_path
+
+    @property
+    def event_id(self):
+        return self.__event_id
+
+
+def property_event(json_object):
+    return PropertyEvent(
+        event_id=json_object['eventId'],
+        timestamp=json_object['timestamp'],
+        event_type=json_object['eventType'],
+        originating_service=json_object['originatingService'],
+        session_id=json_object['sessionId'],
+        details=json_object['details'],
+    )
+
+
+def tuple_event(json_object):
+    return Event.from_json_object(json_object, json_object['timestamp'])
+
+
+def report(name, build):
+    best = min(timeit.repeat(lambda: [build(JSON_OBJECT) for _ in range(NUMBER_OF_EVENTS)], number=1, repeat=REPEAT))
+
+    # The strings and details are shared between events, so this is the memory taken by the events themselves
+    tracemalloc.start()
+    events = [build(JSON_OBJECT) for _ in range(NUMBER_OF_EVENTS)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('{0:<40} {1:8.2f} us and {2:6.0f} bytes per event'.format(
+        name, best / NUMBER_OF_EVENTS * 1e6, size / len(events)))
+
+
+def main():
+    report('object with properties (previous Event)', property_event)
+    report('Event.from_json_object', tuple_event)
+
+
+if __name__ == '__main__':
+    main()
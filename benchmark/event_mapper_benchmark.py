@@ -0,0 +1,36 @@
+import timeit
+from datetime import datetime, timedelta, timezone
+
+import dateutil.parser
+
+from src import event_mapper
+
+NUMBER_OF_TIMESTAMPS = 10000
+REPEAT = 5
+
+
+def timestamps():
+    start = datetime(2018, 2, 10, 12, tzinfo=timezone.utc)
+    return [
+        (start + timedelta(seconds=index, microseconds=index)).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        for index in range(NUMBER_OF_TIMESTAMPS)
+    ]
+
+
+def report(name, parse, values):
+    best = min(timeit.repeat(lambda: [parse(value) for value in values], number=1, repeat=REPEAT))
+    print('{0:<40} {1:8.2f} us per timestamp'.format(name, best / len(values) * 1e6))
+
+
+def main():
+    distinct = timestamps()
+    repeated = distinct[:1] * NUMBER_OF_TIMESTAMPS
+
+    report('dateutil.parser.parse', lambda value: int(dateutil.parser.parse(value).timestamp() * 1000), distinct)
+    # Skip the cache to measure the strict parser on its own
+    report('fast path, distinct timestamps', event_mapper.__parse_timestamp.__wrapped__, distinct)
+    report('fast path, repeated timestamp', event_mapper.__parse_timestamp, repeated)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import json
+import timeit
+import uuid
+
+from src import json_codec
+
+NUMBER_OF_EVENTS = 10000
+REPEAT = 5
+
+
+def billing_event():
+    return {
+        'eventId': str(uuid.uuid4()),
+        'eventType': 'session_event',
+        'timestamp': 1518264452000,
+        'originatingService': 'https://www.signin.service.gov.uk/SAML2/metadata/federation',
+        'sessionId': str(uuid.uuid4()),
+        'details': {
+            'session_event_type': 'idp_authn_succeeded',
+            'pid': str(uuid.uuid4()),
+            'request_id': '_' + uuid.uuid4().hex,
+            'idp_entity_id': 'https://idp.example.com/SAML2/metadata',
+            'transaction_entity_id': 'https://www.example.gov.uk/SAML2/SP',
+            'minimum_level_of_assurance': 'LEVEL_2',
+            'provided_level_of_assurance': 'LEVEL_2',
+            'preferred_level_of_assurance': 'LEVEL_2',
+        },
+    }
+
+
+def fraud_event():
+    event = billing_event()
+    event['details'] = {
+        'session_event_type': 'fraud_detected',
+        'pid': str(uuid.uuid4()),
+        'request_id': '_' + uuid.uuid4().hex,
+        'idp_entity_id': 'https://idp.example.com/SAML2/metadata',
+        'idp_fraud_event_id': 'fraud-event-' + uuid.uuid4().hex,
+        'gpg45_status': 'AA01',
+        'transaction_entity_id': 'https://www.example.gov.uk/SAML2/SP',
+    }
+    return event
+
+
+def report(name, function, values):
+    best = min(timeit.repeat(lambda: [function(value) for value in values], number=1, repeat=REPEAT))
+    print('{0:<30} {1:8.2f} us per event'.format(name, best / len(values) * 1e6))
+
+
+def main():
+    events = [fraud_event() if index % 20 == 0 else billing_event() for index in range(NUMBER_OF_EVENTS)]
+    messages = [json.dumps(event) for event in events]
+    details = [event['details'] for event in events]
+
+    print('orjson is {0}installed'.format('' if json_codec.orjson else 'not '))
+    report('json.loads', json.loads, messages)
+    report('json_codec.loads', json_codec.loads, messages)
+    report('json.dumps', json.dumps, details)
+    report('json_codec.dumps', json_codec.dumps, details)
+
+
+if __name__ == '__main__':
+    main()
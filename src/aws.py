@@ -0,0 +1,50 @@
+import os
+import threading
+
+import boto3
+from botocore.config import Config
+
+DEFAULT_MAX_POOL_CONNECTIONS = 20
+
+__session = None
+__clients = {}
+__lock = threading.Lock()
+
+
+def get_client(service_name):
+    """
+    Returns the client for an AWS service, creating it the first time it is asked for.
+
+    Clients are kept at module level so that warm lambda invocations reuse them, along with the service model botocore
+    has already loaded and the HTTP connections in their pools, which are kept alive between requests.
+    """
+    client = __clients.get(service_name)
+    if client is None:
+        with __lock:
+            client = __clients.get(service_name)
+            if client is None:
+                client = __get_session().client(service_name, config=__client_config())
+                __clients[service_name] = client
+    return client
+
+
+def reset_clients():
+    global __session
+    with __lock:
+        __session = None
+        __clients.clear()
+
+
+def __get_session():
+    # Sessions are not thread safe, so this is only called while holding the lock
+    global __session
+    if __session is None:
+        __session = boto3.session.Session()
+    return __session
+
+
+def __client_config():
+    return Config(
+        max_pool_connections=int(os.environ.get('AWS_MAX_POOL_CONNECTIONS', DEFAULT_MAX_POOL_CONNECTIONS)),
+        retries={'max_attempts': 3},
+    )
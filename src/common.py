@@ -1,8 +1,20 @@
 import os
-import boto3
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import psycopg2
+from psycopg2.extensions import parse_dsn, TRANSACTION_STATUS_IDLE
+
+from src.aws import get_client
+from src.database import create_db_connection
 from src.kms import decrypt
-from psycopg2.extensions import parse_dsn
+
+# IAM authentication tokens are valid for 15 minutes - one is only reused while it has some time left to run
+IAM_TOKEN_LIFETIME_SECONDS = 15 * 60
+IAM_TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+DEFAULT_HEALTH_CHECK_INTERVAL_SECONDS = 10
+DEFAULT_RECORD_WORKERS = 1
 
 
 def get_database_password(dsn):
@@ -11,4 +23,146 @@ def get_database_password(dsn):
         return decrypt(os.environ['ENCRYPTED_DATABASE_PASSWORD']).decode()
     else:
         dsn_components = parse_dsn(dsn)
-        return boto3.client('rds').generate_db_auth_token(dsn_components['host'], 5432, dsn_components['user'])
+        return get_client('rds').generate_db_auth_token(dsn_components['host'], 5432, dsn_components['user'])
+
+
+class DatabaseConnectionManager:
+    """
+    Keeps a single database connection open for the life of the container, so warm invocations don't pay for a new
+    connection, or a new IAM token, each time.
+
+    A connection which has been idle for more than DB_HEALTH_CHECK_INTERVAL_SECONDS is checked with a trivial query
+    before it is handed out again, and replaced if the check fails (for example after a failover).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.__clock = clock
+        self.__connection = None
+        self.__dsn = None
+        self.__last_used_at = None
+        self.__password = None
+        self.__password_key = None
+        self.__password_expires_at = None
+
+    def get_connection(self, dsn, logger):
+        if self.__connection is not None and self.__dsn == dsn and self.__is_usable():
+            logger.info('Reusing connection to DB')
+        else:
+            self.close()
+            self.__connection = create_db_connection(dsn, self.__get_password(dsn))
+            self.__dsn = dsn
+            logger.info('Created connection to DB')
+
+        self.__last_used_at = self.__clock()
+        return self.__connection
+
+    def close(self):
+        if self.__connection is not None:
+            try:
+                self.__connection.close()
+            except psycopg2.Error:
+                pass
+        self.__connection = None
+        self.__dsn = None
+
+    def __is_usable(self):
+        if self.__connection.closed:
+            return False
+
+        try:
+            if self.__connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                # Don't carry anything left over from an earlier invocation into this one
+                self.__connection.rollback()
+            if self.__clock() - self.__last_used_at >= self.__health_check_interval_seconds():
+                with self.__connection.cursor() as cursor:
+                    cursor.execute('SELECT 1')
+                self.__connection.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def __get_password(self, dsn):
+        if 'ENCRYPTED_DATABASE_PASSWORD' in os.environ:
+            # The decrypted password doesn't expire, so it only needs fetching again if the setting changes
+            password_key = os.environ['ENCRYPTED_DATABASE_PASSWORD']
+            expired = False
+        else:
+            password_key = dsn
+            expired = self.__clock() >= self.__password_expires_at if self.__password_expires_at else True
+
+        if self.__password is None or self.__password_key != password_key or expired:
+            self.__password = get_database_password(dsn)
+            self.__password_key = password_key
+            self.__password_expires_at = \
+                self.__clock() + IAM_TOKEN_LIFETIME_SECONDS - IAM_TOKEN_REFRESH_MARGIN_SECONDS
+        return self.__password
+
+    @staticmethod
+    def __health_check_interval_seconds():
+        return int(os.environ.get('DB_HEALTH_CHECK_INTERVAL_SECONDS', DEFAULT_HEALTH_CHECK_INTERVAL_SECONDS))
+
+
+db_connection_manager = DatabaseConnectionManager()
+# The connections for the second and later workers of process_s3_records, which are kept between invocations too
+record_worker_connection_managers = []
+
+
+def get_db_connection(dsn, logger):
+    return db_connection_manager.get_connection(dsn, logger)
+
+
+def process_s3_records(records, process_record, dsn, logger):
+    """
+    Calls process_record(record, db_connection) for each record of an S3 notification, with up to RECORD_WORKERS
+    records being processed at a time.
+
+    With a single worker the records are processed in turn on the connection kept by db_connection_manager. Otherwise
+    the first worker uses that connection and each of the others has a managed connection of its own from
+    record_worker_connection_managers, so warm invocations reuse them as they do the first. A record which fails is
+    logged and the rest are still processed. The first error is raised once every record has been tried, so the
+    invocation still fails.
+    """
+    workers = min(int(os.environ.get('RECORD_WORKERS', DEFAULT_RECORD_WORKERS)), len(records))
+    errors = []
+    if workers <= 1:
+        db_connection = get_db_connection(dsn, logger)
+        for record in records:
+            __process_s3_record(record, process_record, db_connection, errors, logger)
+    else:
+        pending_records = queue.Queue()
+        for record in records:
+            pending_records.put(record)
+        while len(record_worker_connection_managers) < workers - 1:
+            record_worker_connection_managers.append(DatabaseConnectionManager())
+        connection_managers = [db_connection_manager] + record_worker_connection_managers[:workers - 1]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(__process_s3_records_on_managed_connection, pending_records, process_record,
+                                       connection_manager, dsn, errors, logger)
+                       for connection_manager in connection_managers]
+            for future in futures:
+                future.result()
+
+    if errors:
+        raise errors[0]
+
+
+def __process_s3_records_on_managed_connection(pending_records, process_record, connection_manager, dsn, errors,
+                                               logger):
+    db_connection = connection_manager.get_connection(dsn, logger)
+    while True:
+        try:
+            record = pending_records.get_nowait()
+        except queue.Empty:
+            return
+        __process_s3_record(record, process_record, db_connection, errors, logger)
+
+
+def __process_s3_record(record, process_record, db_connection, errors, logger):
+    # noinspection PyBroadException
+    try:
+        process_record(record, db_connection)
+    except Exception as error:
+        logger.exception('Failed to process S3 object {0}/{1}'.format(
+            record['s3']['bucket']['name'], record['s3']['object']['key']))
+        errors.append(error)
@@ -1,11 +1,20 @@
-import json
+import io
 import psycopg2
+from collections import Counter
 from datetime import datetime
 
 from psycopg2._psycopg import IntegrityError
 from psycopg2.errorcodes import UNIQUE_VIOLATION
+from psycopg2.extras import execute_values
 from logging import getLogger
 
+from src import json_codec
+from src.import_checkpoint import ImportCheckpoint
+
+# The details are given as a JSON document and the path to them within it, which is empty if the document is just the
+# details
+AUDIT_EVENT_VALUES_TEMPLATE = '(%s, %s, %s, %s, %s, %s::jsonb #> %s::text[])'
+
 
 def create_db_connection(dsn, database_password):
     if database_password:
@@ -35,15 +44,8 @@ def write_audit_event_to_database(event, db_connection):
                 INSERT INTO audit.audit_events
                 (event_id, event_type, time_stamp, originating_service, session_id, details)
                 VALUES
-                (%s, %s, %s, %s, %s, %s);
-            """, [
-                event.event_id,
-                event.event_type,
-                datetime.fromtimestamp(int(event.timestamp) / 1e3),
-                event.originating_service,
-                event.session_id,
-                json.dumps(event.details)
-            ])
+                (%s, %s, %s, %s, %s, %s::jsonb #> %s::text[]);
+            """, __audit_event_parameters(event))
     except IntegrityError as integrityError:
         if integrityError.pgcode == UNIQUE_VIOLATION:
             # The event has already been recorded - don't throw an exception (no need to retry this message), just
@@ -58,10 +60,68 @@ def write_audit_event_to_database(event, db_connection):
     return True
 
 
+def write_audit_events_to_database(events, db_connection):
+    with RunInTransaction(db_connection) as cursor:
+        return write_audit_events(events, cursor)
+
+
+def write_audit_events(events, cursor):
+    """
+    Inserts a batch of events into the audit table with a single statement.
+
+    Returns a list of booleans in the same order as events, False for each event which was not stored because its
+    Event ID already exists in the database (or earlier in the batch).
+    """
+    if not events:
+        return []
+
+    inserted_rows = execute_values(cursor, """
+        INSERT INTO audit.audit_events
+        (event_id, event_type, time_stamp, originating_service, session_id, details)
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING event_id;
+    """, [__audit_event_parameters(event) for event in events], template=AUDIT_EVENT_VALUES_TEMPLATE,
+        page_size=len(events), fetch=True)
+
+    return __flag_stored_events(events, inserted_rows, 'an audit event')
+
+
+def __audit_event_parameters(event):
+    return [
+        event.event_id,
+        event.event_type,
+        datetime.fromtimestamp(int(event.timestamp) / 1e3),
+        event.originating_service,
+        event.session_id,
+    ] + __audit_event_details_parameters(event)
+
+
+def __audit_event_details_parameters(event):
+    if event.raw_json is not None:
+        # Postgres picks the details out of the JSON the event arrived as, so they don't need encoding again here
+        return [event.raw_json, list(event.details_path)]
+    return [json_codec.dumps(event.details), []]
+
+
+def __flag_stored_events(events, inserted_rows, event_description):
+    inserted_event_ids = Counter(row[0] for row in inserted_rows)
+    stored = []
+    for event in events:
+        if inserted_event_ids[event.event_id] > 0:
+            inserted_event_ids[event.event_id] -= 1
+            stored.append(True)
+        else:
+            # The event has already been recorded - log a notification and move on with the rest of the batch.
+            getLogger('event-recorder').warning(
+                'Failed to store {0}. The Event ID {1} already exists in the database'.format(
+                    event_description, event.event_id))
+            stored.append(False)
+    return stored
+
+
 def write_billing_event_to_database(event, db_connection):
     try:
-        preferred_LOA = event.details['preferred_level_of_assurance'] if 'preferred_level_of_assurance' in event.details else None
-
         with RunInTransaction(db_connection) as cursor:
             cursor.execute("""
                 INSERT INTO billing.billing_events
@@ -79,18 +139,7 @@ def write_billing_event_to_database(event, db_connection):
                 )
                 VALUES
                 (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);
-            """, [
-                datetime.fromtimestamp(int(event.timestamp) / 1e3),
-                event.session_id,
-                event.details['pid'],
-                event.details['request_id'],
-                event.details['idp_entity_id'],
-                event.details['minimum_level_of_assurance'],
-                preferred_LOA,
-                event.details['provided_level_of_assurance'],
-                event.event_id,
-                event.details['transaction_entity_id']
-            ])
+            """, __billing_event_parameters(event))
     except KeyError as keyError:
         getLogger('event-recorder').warning(
             'Failed to store a billing event [Event ID {0}] due to key error'.format(event.event_id))
@@ -108,6 +157,55 @@ def write_billing_event_to_database(event, db_connection):
             raise integrityError
 
 
+def write_billing_events(events, cursor):
+    """
+    Inserts a batch of billing events with a single statement, skipping (and logging) any which already exist.
+    """
+    if not events:
+        return []
+
+    # The details have already been checked against the billing route when the events were mapped
+    parameters = [__billing_event_parameters(event) for event in events]
+
+    inserted_rows = execute_values(cursor, """
+        INSERT INTO billing.billing_events
+        (
+            time_stamp,
+            session_id,
+            hashed_persistent_id,
+            request_id,
+            idp_entity_id,
+            minimum_level_of_assurance,
+            preferred_level_of_assurance,
+            provided_level_of_assurance,
+            event_id,
+            transaction_entity_id
+        )
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING event_id;
+    """, parameters, page_size=len(parameters), fetch=True)
+
+    return __flag_stored_events(events, inserted_rows, 'a billing event')
+
+
+def __billing_event_parameters(event):
+    preferred_LOA = event.details['preferred_level_of_assurance'] if 'preferred_level_of_assurance' in event.details else None
+
+    return [
+        datetime.fromtimestamp(int(event.timestamp) / 1e3),
+        event.session_id,
+        event.details['pid'],
+        event.details['request_id'],
+        event.details['idp_entity_id'],
+        event.details['minimum_level_of_assurance'],
+        preferred_LOA,
+        event.details['provided_level_of_assurance'],
+        event.event_id,
+        event.details['transaction_entity_id']
+    ]
+
+
 def write_fraud_event_to_database(event, db_connection):
     try:
         with RunInTransaction(db_connection) as cursor:
@@ -126,17 +224,7 @@ def write_fraud_event_to_database(event, db_connection):
                 )
                 VALUES
                 (%s, %s, %s, %s, %s, %s, %s, %s, %s);
-            """, [
-                event.event_id,
-                datetime.fromtimestamp(int(event.timestamp) / 1e3),
-                event.session_id,
-                event.details['pid'],
-                event.details['request_id'],
-                event.details['idp_entity_id'],
-                event.details['idp_fraud_event_id'],
-                event.details['gpg45_status'],
-                event.details['transaction_entity_id']
-            ])
+            """, __fraud_event_parameters(event))
     except KeyError as keyError:
         getLogger('event-recorder').warning(
             'Failed to store a fraud event [Event ID {0}] due to key error'.format(event.event_id))
@@ -153,6 +241,286 @@ def write_fraud_event_to_database(event, db_connection):
             raise integrityError
 
 
+def write_fraud_events(events, cursor):
+    """
+    Inserts a batch of fraud events with a single statement, skipping (and logging) any which already exist.
+    """
+    if not events:
+        return []
+
+    # The details have already been checked against the fraud route when the events were mapped
+    parameters = [__fraud_event_parameters(event) for event in events]
+
+    inserted_rows = execute_values(cursor, """
+        INSERT INTO billing.fraud_events
+        (
+            event_id,
+            time_stamp,
+            session_id,
+            hashed_persistent_id,
+            request_id,
+            entity_id,
+            fraud_event_id,
+            fraud_indicator,
+            transaction_entity_id
+        )
+        VALUES %s
+        ON CONFLICT DO NOTHING
+        RETURNING event_id;
+    """, parameters, page_size=len(parameters), fetch=True)
+
+    return __flag_stored_events(events, inserted_rows, 'a fraud event')
+
+
+def __fraud_event_parameters(event):
+    return [
+        event.event_id,
+        datetime.fromtimestamp(int(event.timestamp) / 1e3),
+        event.session_id,
+        event.details['pid'],
+        event.details['request_id'],
+        event.details['idp_entity_id'],
+        event.details['idp_fraud_event_id'],
+        event.details['gpg45_status'],
+        event.details['transaction_entity_id']
+    ]
+
+
+def create_import_staging_table(cursor):
+    """
+    Creates the temporary table an import file is copied into before it is stored. It is dropped when the transaction
+    ends.
+    """
+    cursor.execute("""
+        CREATE TEMPORARY TABLE import_staging
+        (
+            line_number bigint NOT NULL,
+            event_id text NOT NULL,
+            event_type text NOT NULL,
+            time_stamp timestamp NOT NULL,
+            originating_service text NOT NULL,
+            session_id text,
+            raw_json jsonb NOT NULL,
+            routes text[] NOT NULL,
+            stored boolean NOT NULL DEFAULT FALSE
+        )
+        ON COMMIT DROP;
+    """)
+
+
+def copy_to_import_staging_table(staged_events, cursor):
+    """
+    Streams (line number, event, route names) tuples into the staging table with COPY. The events must have been read
+    from JSON, which is staged as it is.
+    """
+    cursor.copy_expert("""
+        COPY import_staging
+        (line_number, event_id, event_type, time_stamp, originating_service, session_id, raw_json, routes)
+        FROM STDIN WITH (FORMAT csv)
+    """, CsvRowReader(__staging_row(*staged_event) for staged_event in staged_events))
+
+
+def __staging_row(line_number, event, route_names):
+    return [
+        line_number,
+        event.event_id,
+        event.event_type,
+        datetime.fromtimestamp(int(event.timestamp) / 1e3).isoformat(),
+        event.originating_service,
+        event.session_id,
+        event.raw_json,
+        '{' + ','.join(route_names) + '}',
+    ]
+
+
+def insert_staged_audit_events(details_path, cursor):
+    """
+    Inserts the staged events into the audit table with a single statement, keeping the first line for each Event ID
+    and skipping any which already exist. The staged events which were stored are flagged for the derived tables.
+
+    Returns the number of events stored.
+    """
+    cursor.execute("""
+        DELETE FROM import_staging AS later
+        USING import_staging AS earlier
+        WHERE later.event_id = earlier.event_id
+        AND later.line_number > earlier.line_number;
+    """)
+    cursor.execute("""
+        WITH inserted AS (
+            INSERT INTO audit.audit_events
+            (event_id, event_type, time_stamp, originating_service, session_id, details)
+            SELECT event_id, event_type, time_stamp, originating_service, session_id, raw_json #> %s::text[]
+            FROM import_staging
+            ORDER BY line_number
+            ON CONFLICT DO NOTHING
+            RETURNING event_id
+        )
+        UPDATE import_staging
+        SET stored = TRUE
+        FROM inserted
+        WHERE import_staging.event_id = inserted.event_id;
+    """, [list(details_path)])
+    return cursor.rowcount
+
+
+def insert_staged_billing_events(route_name, details_path, cursor):
+    cursor.execute("""
+        INSERT INTO billing.billing_events
+        (
+            time_stamp,
+            session_id,
+            hashed_persistent_id,
+            request_id,
+            idp_entity_id,
+            minimum_level_of_assurance,
+            preferred_level_of_assurance,
+            provided_level_of_assurance,
+            event_id,
+            transaction_entity_id
+        )
+        SELECT
+            time_stamp,
+            session_id,
+            details->>'pid',
+            details->>'request_id',
+            details->>'idp_entity_id',
+            details->>'minimum_level_of_assurance',
+            details->>'preferred_level_of_assurance',
+            details->>'provided_level_of_assurance',
+            event_id,
+            details->>'transaction_entity_id'
+        FROM (
+            SELECT *, raw_json #> %s::text[] AS details
+            FROM import_staging
+            WHERE stored AND %s = ANY(routes)
+        ) AS staged
+        ORDER BY line_number
+        ON CONFLICT DO NOTHING;
+    """, [list(details_path), route_name])
+    return cursor.rowcount
+
+
+def insert_staged_fraud_events(route_name, details_path, cursor):
+    cursor.execute("""
+        INSERT INTO billing.fraud_events
+        (
+            event_id,
+            time_stamp,
+            session_id,
+            hashed_persistent_id,
+            request_id,
+            entity_id,
+            fraud_event_id,
+            fraud_indicator,
+            transaction_entity_id
+        )
+        SELECT
+            event_id,
+            time_stamp,
+            session_id,
+            details->>'pid',
+            details->>'request_id',
+            details->>'idp_entity_id',
+            details->>'idp_fraud_event_id',
+            details->>'gpg45_status',
+            details->>'transaction_entity_id'
+        FROM (
+            SELECT *, raw_json #> %s::text[] AS details
+            FROM import_staging
+            WHERE stored AND %s = ANY(routes)
+        ) AS staged
+        ORDER BY line_number
+        ON CONFLICT DO NOTHING;
+    """, [list(details_path), route_name])
+    return cursor.rowcount
+
+
+def read_import_checkpoint(bucket, key, etag, db_connection):
+    """
+    Returns the checkpoint for this version of the file, which is at the start of the file if it has none.
+    """
+    with RunInTransaction(db_connection) as cursor:
+        cursor.execute("""
+            SELECT
+                byte_offset,
+                line_number
+            FROM
+                audit.import_checkpoints
+            WHERE
+                bucket = %s AND key = %s AND etag = %s;
+        """, [bucket, key, etag])
+        row = cursor.fetchone()
+
+    if row is None:
+        return ImportCheckpoint(bucket, key, etag)
+    return ImportCheckpoint(bucket, key, etag, row[0], row[1])
+
+
+def write_import_checkpoint(checkpoint, cursor):
+    cursor.execute("""
+        INSERT INTO audit.import_checkpoints
+        (bucket, key, etag, byte_offset, line_number)
+        VALUES
+        (%s, %s, %s, %s, %s)
+        ON CONFLICT (bucket, key, etag)
+        DO UPDATE SET byte_offset = EXCLUDED.byte_offset, line_number = EXCLUDED.line_number, time_stamp = now();
+    """, [checkpoint.bucket, checkpoint.key, checkpoint.etag, checkpoint.byte_offset, checkpoint.line_number])
+
+
+def delete_import_checkpoint(checkpoint, db_connection):
+    """
+    Deletes the checkpoints for every version of the file, as an import of an earlier version which was cut short will
+    never be resumed now.
+    """
+    with RunInTransaction(db_connection) as cursor:
+        cursor.execute("""
+            DELETE FROM audit.import_checkpoints
+            WHERE bucket = %s AND key = %s;
+        """, [checkpoint.bucket, checkpoint.key])
+
+
+class CsvRowReader(io.TextIOBase):
+    """
+    Reads rows as CSV text for COPY, formatting them only as they are consumed, so a whole file can be streamed without
+    all of it being held in memory. Strings are always quoted and None never is, so COPY can tell an empty string from
+    NULL.
+    """
+
+    def __init__(self, rows):
+        self.__rows = iter(rows)
+        self.__buffer = io.StringIO()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size is None or size < 0 or self.__buffer.tell() < size:
+            row = next(self.__rows, None)
+            if row is None:
+                break
+            self.__buffer.write(','.join(self.__csv_field(value) for value in row))
+            self.__buffer.write('\n')
+
+        text = self.__buffer.getvalue()
+        if size is not None and 0 <= size < len(text):
+            text, remainder = text[:size], text[size:]
+        else:
+            remainder = ''
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+        self.__buffer.write(remainder)
+        return text
+
+    @staticmethod
+    def __csv_field(value):
+        if value is None:
+            return ''
+        if isinstance(value, int):
+            return str(value)
+        return '"' + str(value).replace('"', '""') + '"'
+
+
 def write_import_session(upload_session, db_connection, logger):
     try:
         with RunInTransaction(db_connection) as cursor:
@@ -271,6 +639,87 @@ def write_idp_fraud_event_to_database(upload_session, idp_fraud_event, cursor, l
         raise integrityError
 
 
+def write_idp_fraud_events_to_database(upload_session, idp_fraud_events, cursor, logger):
+    """
+    Inserts a chunk of IDP fraud events with a single multi-row statement and returns their ids, in the same order.
+
+    The ids are taken from the table's sequence up front so each event's contraindicators can be matched to its row.
+    The contraindicator counts for the whole chunk are added up before being written with a single upsert.
+    """
+    if not idp_fraud_events:
+        return []
+
+    try:
+        cursor.execute("""
+            SELECT nextval(pg_get_serial_sequence('idp_data.idp_fraud_events', 'id'))
+              FROM generate_series(1, %s)
+        """, [len(idp_fraud_events)])
+        ids = [row[0] for row in cursor.fetchall()]
+
+        execute_values(cursor, """
+             INSERT INTO idp_data.idp_fraud_events
+             (
+                id,
+                idp_entity_id,
+                idp_event_id,
+                time_stamp,
+                fid_code,
+                request_id,
+                pid,
+                client_ip_address,
+                contra_score,
+                upload_session_id
+             )
+             VALUES %s
+        """, [
+            (
+                id,
+                idp_fraud_event.idp_entity_id,
+                idp_fraud_event.idp_event_id,
+                idp_fraud_event.timestamp,
+                idp_fraud_event.fid_code,
+                idp_fraud_event.request_id,
+                idp_fraud_event.pid,
+                idp_fraud_event.client_ip_address,
+                idp_fraud_event.contra_score,
+                upload_session.id
+            )
+            for id, idp_fraud_event in zip(ids, idp_fraud_events)
+        ], page_size=len(idp_fraud_events))
+
+        contra_indicator_counts = Counter(
+            (id, contra_indicator)
+            for id, idp_fraud_event in zip(ids, idp_fraud_events)
+            for contra_indicator in idp_fraud_event.contra_indicators
+        )
+        if contra_indicator_counts:
+            execute_values(cursor, """
+                INSERT INTO idp_data.idp_fraud_event_contraindicators
+                (
+                    idp_fraud_events_id,
+                    contraindicator_code,
+                    count
+                )
+                VALUES %s
+                ON CONFLICT (idp_fraud_events_id, contraindicator_code)
+                DO UPDATE SET count = idp_fraud_event_contraindicators.count + EXCLUDED.count
+            """, [
+                (id, contra_indicator, count)
+                for (id, contra_indicator), count in contra_indicator_counts.items()
+            ], page_size=len(contra_indicator_counts))
+
+        return ids
+
+    except KeyError as keyError:
+        logger.exception(
+            'Failed to store a chunk of {} IDP fraud events due to key error'.format(len(idp_fraud_events)))
+        raise keyError
+    except IntegrityError as integrityError:
+        logger.exception(
+            'Failed to store a chunk of {} IDP fraud events due to integrity error'.format(len(idp_fraud_events)))
+        raise integrityError
+
+
 def update_session_as_validated(upload_session, db_connection):
     with RunInTransaction(db_connection) as cursor:
         cursor.execute("""
@@ -298,3 +747,20 @@ def write_upload_error(upload_session, row, field, message, db_connection):
                 %s
             )
         """, [upload_session.id, row, field, message])
+
+
+def write_upload_errors(upload_session, errors, db_connection):
+    """
+    Records every validation failure for an upload in a single transaction. Each error is a (row, field, message) tuple.
+    """
+    with RunInTransaction(db_connection) as cursor:
+        execute_values(cursor, """
+            INSERT INTO idp_data.upload_session_validation_failures
+            (
+                upload_session_id,
+                row,
+                field,
+                message
+            )
+            VALUES %s
+        """, [(upload_session.id, row, field, message) for (row, field, message) in errors])
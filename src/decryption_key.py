@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+
+from src.decryption import decrypt_message
+from src.kms import decrypt
+from src.s3 import fetch_decryption_key
+
+DEFAULT_CACHE_TTL_SECONDS = 3600
+# A key is not fetched again any sooner than this after it was fetched, so that a run of messages which are
+# themselves corrupt can't cause a call to S3 and KMS for every message.
+MIN_REFRESH_INTERVAL_SECONDS = 60
+
+
+def fetch_and_decrypt_key():
+    logger = logging.getLogger('event-recorder')
+    if 'ENCRYPTION_KEY' in os.environ:
+        encrypted_decryption_key = os.environ['ENCRYPTION_KEY']
+        logger.info('Got decryption key from environment variable')
+    else:
+        encrypted_decryption_key = fetch_decryption_key()
+        logger.info('Got decryption key from S3')
+    decryption_key = decrypt(encrypted_decryption_key)
+    logger.info('Decrypted key successfully')
+    return decryption_key
+
+
+class DecryptionKeyCache:
+    """
+    Keeps the decrypted data key in memory so warm invocations don't need to call S3 and KMS before handling the
+    first message. The key is fetched again once it is older than DECRYPTION_KEY_CACHE_TTL_SECONDS, after it is
+    invalidated, or when a message can't be decrypted with it (in case the key has been rotated).
+    """
+
+    def __init__(self, fetch_key=fetch_and_decrypt_key, clock=time.monotonic):
+        self.__fetch_key = fetch_key
+        self.__clock = clock
+        self.__lock = threading.Lock()
+        self.__key = None
+        self.__fetched_at = None
+
+    def get_key(self):
+        with self.__lock:
+            if self.__key is None or self.__clock() - self.__fetched_at >= self.__ttl_seconds():
+                self.__fetch()
+            return self.__key
+
+    def invalidate(self):
+        with self.__lock:
+            self.__key = None
+
+    def decrypt_message(self, base64_encrypted_message):
+        decryption_key = self.get_key()
+        try:
+            return decrypt_message(base64_encrypted_message, decryption_key)
+        except Exception:
+            refreshed_key = self.__refresh(decryption_key)
+            if refreshed_key is None:
+                raise
+            return decrypt_message(base64_encrypted_message, refreshed_key)
+
+    def __refresh(self, failed_key):
+        """
+        Returns a different key to try, or None if there isn't one.
+        """
+        with self.__lock:
+            if self.__key is not None and self.__key != failed_key:
+                # Another message has already caused the key to be fetched again
+                return self.__key
+            if self.__key is not None and self.__clock() - self.__fetched_at < MIN_REFRESH_INTERVAL_SECONDS:
+                return None
+
+            self.__fetch()
+            return self.__key if self.__key != failed_key else None
+
+    def __fetch(self):
+        self.__key = self.__fetch_key()
+        self.__fetched_at = self.__clock()
+
+    @staticmethod
+    def __ttl_seconds():
+        return int(os.environ.get('DECRYPTION_KEY_CACHE_TTL_SECONDS', DEFAULT_CACHE_TTL_SECONDS))
+
+
+decryption_key_cache = DecryptionKeyCache()
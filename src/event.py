@@ -1,32 +1,57 @@
-class Event(object):
-    def __init__(self, event_id, timestamp, event_type, originating_service, session_id, details):
-        self.__event_id = event_id
-        self.__timestamp = timestamp
-        self.__originating_service = originating_service
-        self.__session_id = session_id
-        self.__event_type = event_type
-        self.__details = details
-
-    @property
-    def event_id(self):
-        return self.__event_id
-
-    @property
-    def timestamp(self):
-        return self.__timestamp
-
-    @property
-    def event_type(self):
-        return self.__event_type
-
-    @property
-    def originating_service(self):
-        return self.__originating_service
-
-    @property
-    def session_id(self):
-        return self.__session_id
-
-    @property
-    def details(self):
-        return self.__details
+from collections import namedtuple
+
+EVENT_ID = 'eventId'
+EVENT_TYPE = 'eventType'
+TIMESTAMP = 'timestamp'
+ORIGINATING_SERVICE = 'originatingService'
+SESSION_ID = 'sessionId'
+DETAILS = 'details'
+
+EventFields = namedtuple('EventFields', [
+    'event_id',
+    'timestamp',
+    'event_type',
+    'originating_service',
+    'session_id',
+    'details',
+    'raw_json',
+    'details_path',
+])
+EventFields.__new__.__defaults__ = (None, ())
+
+
+class InvalidEventError(ValueError):
+    """
+    Raised for an event which was read, but is missing something it needs before it can be stored.
+    """
+
+
+class Event(EventFields):
+    """
+    An immutable event, held as a tuple so that batches of thousands of events stay small.
+
+    raw_json, when set, is the JSON text the event was read from, and details_path the path to the details within it,
+    so the details can be stored without being encoded again.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_json_object(cls, json_object, timestamp, raw_json=None, details_path=()):
+        """
+        Builds an event from a parsed message which has already been validated, with its timestamp in epoch
+        milliseconds.
+        """
+        event_type = json_object[EVENT_TYPE]
+        # Error events are the only ones which may be sent without a session
+        session_id = '' if event_type == 'error_event' and SESSION_ID not in json_object else json_object[SESSION_ID]
+        return tuple.__new__(cls, (
+            json_object[EVENT_ID],
+            timestamp,
+            event_type,
+            json_object[ORIGINATING_SERVICE],
+            session_id,
+            json_object[DETAILS],
+            raw_json,
+            details_path,
+        ))
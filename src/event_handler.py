@@ -1,77 +1,282 @@
 import logging
 import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-
-from src.common import get_database_password
-from src.database import create_db_connection, write_audit_event_to_database, \
-    write_billing_event_to_database, write_fraud_event_to_database
-from src.decryption import decrypt_message
+from src.aws import get_client
+from src.common import get_db_connection
+from src.database import write_audit_event_to_database, write_audit_events, RunInTransaction
+from src.decryption_key import decryption_key_cache
+from src.event import InvalidEventError
 from src.event_mapper import event_from_json
-from src.kms import decrypt
-from src.s3 import fetch_decryption_key
-from src.sqs import fetch_single_message, delete_message
+from src.event_routing import routes_for, write_routed_events
+from src.sqs import MessageDeleter, PrefetchingReceiver, MAX_NUMBER_OF_MESSAGES, DEFAULT_PREFETCH_DEPTH, \
+    release_messages
+
+DEFAULT_DECODE_WORKERS = 1
+# No new messages are taken once the lambda has less than this long left, leaving time to store the ones in hand
+DEFAULT_DRAIN_DEADLINE_MARGIN_MILLIS = 20000
+
+# The outcome of decrypting and mapping one message - error is set instead of event if either step failed
+DecodedMessage = namedtuple('DecodedMessage', ['message', 'decrypted_message', 'event', 'error'])
 
 
 # noinspection PyUnusedLocal
-def store_queued_events(_, __):
-    sqs_client = boto3.client('sqs')
+def store_queued_events(_, context):
+    drain_queue(context)
+
+
+def drain_queue(context, wait_time_seconds=0):
+    """
+    Stores events from the queue until it is found to be empty, or context reports that there is little time left,
+    and returns the number of messages taken from the queue.
+    """
+    sqs_client = get_client('sqs')
     queue_url = os.environ['QUEUE_URL']
 
     logger = logging.getLogger('event-recorder')
     logger.setLevel(logging.INFO)
 
-    if 'ENCRYPTION_KEY' in os.environ:
-        encrypted_decryption_key = os.environ['ENCRYPTION_KEY']
-        logger.info('Got decryption key from environment variable')
-    else:
-        encrypted_decryption_key = fetch_decryption_key()
-        logger.info('Got decryption key from S3')
-    decryption_key = decrypt(encrypted_decryption_key)
-    logger.info('Decrypted key successfully')
+    # Make sure the key can be fetched before taking any messages from the queue
+    decryption_key_cache.get_key()
 
     dsn = os.environ['DB_CONNECTION_STRING']
 
-    db_connection = create_db_connection(dsn, get_database_password(dsn))
-    logger.info('Created connection to DB')
+    db_connection = get_db_connection(dsn, logger)
+
+    prefetch_depth = int(os.environ.get('RECEIVE_PREFETCH_DEPTH', DEFAULT_PREFETCH_DEPTH))
+    deadline_margin_millis = int(os.environ.get('DRAIN_DEADLINE_MARGIN_MILLIS', DEFAULT_DRAIN_DEADLINE_MARGIN_MILLIS))
 
     event_count = 0
-    while True:
-        message = fetch_single_message(sqs_client, queue_url)
-        if message is None:
+    with MessageDeleter(sqs_client, queue_url, context) as message_deleter, \
+            PrefetchingReceiver(sqs_client, queue_url, prefetch_depth, wait_time_seconds) as receiver:
+        messages = __until_deadline(receiver, context, deadline_margin_millis)
+        for message, event, stored in __store_decoded_messages(__decode_messages(messages), db_connection, logger):
+            event_count += 1
+            if stored:
+                message_deleter.add(message, event.event_id)
+        message_deleter.flush()
+
+        # Anything received but not started on is made visible again now, rather than when its visibility timeout ends
+        unprocessed_messages = receiver.close()
+        release_messages(sqs_client, queue_url, unprocessed_messages)
+        if __is_near_deadline(context, deadline_margin_millis):
+            logger.info('Close to the lambda deadline - finishing after {0} events and releasing {1} messages'.format(
+                event_count, len(unprocessed_messages)))
+        else:
             logger.info('Queue is empty - finishing after {0} events'.format(event_count))
-            break
 
-        event_count += 1
+    return event_count
+
+
+# noinspection PyUnusedLocal
+def store_sqs_events(event, context):
+    """
+    Entry point for an SQS event source mapping. Stores the events from the messages in event['Records'] and reports
+    the messages which could not be stored as batch item failures, so only those are delivered again. The event source
+    mapping deletes the others from the queue.
+    """
+    logger = logging.getLogger('event-recorder')
+    logger.setLevel(logging.INFO)
+
+    decryption_key_cache.get_key()
+
+    dsn = os.environ['DB_CONNECTION_STRING']
+
+    db_connection = get_db_connection(dsn, logger)
+
+    messages = [__message_from_record(record) for record in event['Records']]
+    failed_message_ids = []
+    for message, _, stored in __store_decoded_messages(__decode_messages(messages), db_connection, logger):
+        if not stored:
+            failed_message_ids.append(message['MessageId'])
+
+    logger.info('Stored {0} of {1} events from SQS'.format(len(messages) - len(failed_message_ids), len(messages)))
+    return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+
+
+def __message_from_record(record):
+    # Records from an event source mapping carry the same message as ReceiveMessage, with lower camel case keys
+    return {'MessageId': record['messageId'], 'ReceiptHandle': record['receiptHandle'], 'Body': record['body']}
+
 
-        # noinspection PyBroadException
-        # catch all errors and log them - we never want a single failing message to kill the process.
-        event = None
+def __until_deadline(messages, context, margin_millis):
+    messages = iter(messages)
+    while not __is_near_deadline(context, margin_millis):
         try:
-            decrypted_message = decrypt_message(message['Body'], decryption_key)
-            event = event_from_json(decrypted_message)
-
-            # Send audit events to this lambda function's CloudWatch log group.
-            # This is the raw JSON event on a line by its self so Splunk can
-            # parse it as JSON.
-            print(decrypted_message)
-
-            logger.info('Decrypted event with ID: {0}'.format(event.event_id))
-            write_audit_event_to_database(event, db_connection)
-            logger.info('Stored audit event: {0}'.format(event.event_id))
-            if event.event_type == 'session_event' and event.details.get('session_event_type') == 'idp_authn_succeeded':
-                write_billing_event_to_database(event, db_connection)
-                logger.info('Stored billing event: {0}'.format(event.event_id))
-            if event.event_type == 'session_event' and event.details.get('session_event_type') == 'fraud_detected':
-                write_fraud_event_to_database(event, db_connection)
-                logger.info('Stored fraud event: {0}'.format(event.event_id))
-            delete_message(sqs_client, queue_url, message)
-            logger.info('Deleted event from queue with ID: {0}'.format(event.event_id))
-        except Exception:
-            if event:
-                logger.exception(
-                    'Failed to store event {0}, event type "{1}" from SQS message ID {2}'.format(event.event_id,
-                                                                                                 event.event_type,
-                                                                                                 message['MessageId']))
-            else:
-                logger.exception('Failed to decrypt message, SQS ID = {0}'.format(message['MessageId']))
+            yield next(messages)
+        except StopIteration:
+            return
+
+
+def __is_near_deadline(context, margin_millis):
+    return context is not None and context.get_remaining_time_in_millis() < margin_millis
+
+
+def __decode_messages(messages):
+    """
+    Decrypts and maps messages, yielding the results in the order the messages were received.
+
+    Messages are decoded inline unless more than one DECODE_WORKERS is configured, in which case they are decoded on a
+    thread pool. The pool runs ahead of the caller by at most DECODE_QUEUE_SIZE messages, so the database writer never
+    waits for decryption and the pool never holds more of the queue than the writer can get through before the
+    messages become visible again.
+    """
+    workers = int(os.environ.get('DECODE_WORKERS', DEFAULT_DECODE_WORKERS))
+    queue_size = int(os.environ.get('DECODE_QUEUE_SIZE', workers * MAX_NUMBER_OF_MESSAGES))
+
+    if workers <= 1:
+        for message in messages:
+            yield __decode_message(message)
+        return
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for message in messages:
+            pending.append(executor.submit(__decode_message, message))
+            if len(pending) >= max(queue_size, 1):
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def __decode_message(message):
+    # noinspection PyBroadException
+    # catch all errors and report them - we never want a single failing message to kill the process.
+    try:
+        decrypted_message = decryption_key_cache.decrypt_message(message['Body'])
+        return DecodedMessage(message, decrypted_message, event_from_json(decrypted_message), None)
+    except Exception as error:
+        return DecodedMessage(message, None, None, error)
+
+
+def __log_decoded_message(decoded_message, logger):
+    """
+    Logs the outcome of decoding a message and returns its event, or None if it could not be decoded. This is done
+    by the writer rather than the decode workers, so the log for each message stays in order and in one place.
+    """
+    if isinstance(decoded_message.error, InvalidEventError):
+        logger.error('Invalid event from SQS message ID {0}: {1}'.format(
+            decoded_message.message['MessageId'], decoded_message.error))
+        return None
+    if decoded_message.error is not None:
+        logger.error('Failed to decrypt message, SQS ID = {0}'.format(decoded_message.message['MessageId']),
+                     exc_info=decoded_message.error)
+        return None
+
+    # Send audit events to this lambda function's CloudWatch log group.
+    # This is the raw JSON event on a line by its self so Splunk can
+    # parse it as JSON.
+    print(decoded_message.decrypted_message)
+
+    logger.info('Decrypted event with ID: {0}'.format(decoded_message.event.event_id))
+    return decoded_message.event
+
+
+def __store_decoded_messages(decoded_messages, db_connection, logger):
+    """
+    Stores the events from decoded messages, yielding (message, event, stored) for every message once its outcome is
+    known. event is None for a message which could not be decoded.
+
+    Group commit is off unless a GROUP_COMMIT_SIZE or GROUP_COMMIT_BYTES budget is configured - each event is then
+    committed on its own.
+    """
+    group_commit_size = int(os.environ.get('GROUP_COMMIT_SIZE', 0))
+    group_commit_bytes = int(os.environ.get('GROUP_COMMIT_BYTES', 0))
+
+    group = []
+    group_bytes = 0
+    for decoded_message in decoded_messages:
+        message = decoded_message.message
+        event = __log_decoded_message(decoded_message, logger)
+        if event is None:
+            yield message, None, False
+            continue
+
+        if not (group_commit_size or group_commit_bytes):
+            yield message, event, __store_event(message, event, db_connection, logger)
+            continue
+
+        group.append((message, event))
+        group_bytes += len(message['Body'])
+        if (group_commit_size and len(group) >= group_commit_size) or \
+                (group_commit_bytes and group_bytes >= group_commit_bytes):
+            yield from __store_group(group, db_connection, logger)
+            group = []
+            group_bytes = 0
+
+    yield from __store_group(group, db_connection, logger)
+
+
+def __store_event(message, event, db_connection, logger):
+    # noinspection PyBroadException
+    try:
+        write_audit_event_to_database(event, db_connection)
+        logger.info('Stored audit event: {0}'.format(event.event_id))
+        for route in routes_for(event):
+            route.write_event(event, db_connection)
+            logger.info('Stored {0} event: {1}'.format(route.name, event.event_id))
+        return True
+    except Exception:
+        __log_store_failure(message, event, logger)
+        return False
+
+
+def __store_group(group, db_connection, logger):
+    """
+    Writes the audit rows, and the rows for each derived table, for a group of events in a single transaction,
+    yielding the outcome for each event in the same way as __store_decoded_messages.
+
+    If the group cannot be committed it is written again with each event in its own savepoint, so one bad event does
+    not stop the rest of the group from being stored.
+    """
+    if not group:
+        return
+
+    # noinspection PyBroadException
+    try:
+        with RunInTransaction(db_connection) as cursor:
+            __write_events([event for _, event in group], cursor)
+        stored = group
+    except Exception:
+        logger.warning('Failed to store a group of {0} events - retrying each event on its own'.format(len(group)))
+        stored = __store_group_with_savepoints(group, db_connection, logger)
+
+    logger.info('Stored {0} events in a single transaction'.format(len(stored)))
+    stored_messages = {id(message) for message, _ in stored}
+    for message, event in group:
+        yield message, event, id(message) in stored_messages
+
+
+def __store_group_with_savepoints(group, db_connection, logger):
+    stored = []
+    # noinspection PyBroadException
+    try:
+        with RunInTransaction(db_connection) as cursor:
+            for message, event in group:
+                cursor.execute('SAVEPOINT group_commit_event')
+                try:
+                    __write_events([event], cursor)
+                except Exception:
+                    cursor.execute('ROLLBACK TO SAVEPOINT group_commit_event')
+                    __log_store_failure(message, event, logger)
+                    continue
+                cursor.execute('RELEASE SAVEPOINT group_commit_event')
+                stored.append((message, event))
+    except Exception:
+        logger.exception('Failed to commit a group of {0} events'.format(len(group)))
+        return []
+
+    return stored
+
+
+def __write_events(events, cursor):
+    write_audit_events(events, cursor)
+    write_routed_events(events, cursor)
+
+
+def __log_store_failure(message, event, logger):
+    logger.exception(
+        'Failed to store event {0}, event type "{1}" from SQS message ID {2}'.format(event.event_id,
+                                                                                     event.event_type,
+                                                                                     message['MessageId']))
@@ -1,50 +1,53 @@
-import json
+from functools import lru_cache
+
 import dateutil.parser
-from src.event import Event
-
-EVENT_ID = 'eventId'
-EVENT_TYPE = 'eventType'
-TIMESTAMP = 'timestamp'
-ORIGINATING_SERVICE = 'originatingService'
-SESSION_ID = 'sessionId'
-DETAILS = 'details'
+from src import json_codec
+from src.event import Event, EVENT_ID, EVENT_TYPE, TIMESTAMP, ORIGINATING_SERVICE, DETAILS, InvalidEventError
+from src.event_routing import validate_details
+from src.iso_8601 import parse_iso_8601_timestamp
+
 REQUIRED_FIELDS = [EVENT_ID, EVENT_TYPE, TIMESTAMP, ORIGINATING_SERVICE, DETAILS]
 
+TIMESTAMP_CACHE_SIZE = 1024
+
 
 def event_from_json(json_string):
-    json_object = json.loads(json_string)
-    return event_from_json_object(json_object)
+    json_object = json_codec.loads(json_string)
+    return event_from_json_object(json_object, json_string, (DETAILS,))
 
 
-def event_from_json_object(json_object):
+def event_from_json_object(json_object, raw_json=None, details_path=()):
+    """
+    raw_json is the JSON text json_object was read from, if any, and details_path the keys leading from the top of
+    that text to this object's details.
+    """
     __validate_json_object(json_object)
-    if json_object[EVENT_TYPE] == 'error_event' and SESSION_ID not in json_object:
-        return Event(
-            event_id=json_object[EVENT_ID],
-            timestamp=__date_checker(json_object[TIMESTAMP]),
-            event_type=json_object[EVENT_TYPE],
-            originating_service=json_object[ORIGINATING_SERVICE],
-            session_id='',
-            details=json_object[DETAILS],
-        )
-    return Event(
-        event_id=json_object[EVENT_ID],
-        timestamp=__date_checker(json_object[TIMESTAMP]),
-        event_type=json_object[EVENT_TYPE],
-        originating_service=json_object[ORIGINATING_SERVICE],
-        session_id=json_object[SESSION_ID],
-        details=json_object[DETAILS],
-    )
+    return Event.from_json_object(json_object, __date_checker(json_object[TIMESTAMP]), raw_json, details_path)
 
 
 def __validate_json_object(json_object):
     for field in REQUIRED_FIELDS:
         if field not in json_object:
-            raise ValueError('Invalid Message. Missing required field "{0}"'.format(field))
+            raise InvalidEventError('Invalid Message. Missing required field "{0}"'.format(field))
+    # Reject an event the derived tables can't take now, rather than after its audit row has been written
+    validate_details(json_object[EVENT_TYPE], json_object[DETAILS])
 
 
 def __date_checker(date_time):
     if isinstance(date_time, str):
-        return int(dateutil.parser.parse(date_time).timestamp() * 1000)
+        return __parse_timestamp(date_time)
 
     return date_time
+
+
+# Bursts of events are often sent with the same timestamp, so recent results are kept
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def __parse_timestamp(timestamp):
+    try:
+        date_time = parse_iso_8601_timestamp(timestamp)
+    except ValueError:
+        date_time = None
+    if date_time is None:
+        date_time = dateutil.parser.parse(timestamp)
+
+    return int(date_time.timestamp() * 1000)
@@ -0,0 +1,111 @@
+from collections import OrderedDict, namedtuple
+
+from src.database import write_billing_event_to_database, write_billing_events, write_fraud_event_to_database, \
+    write_fraud_events, insert_staged_billing_events, insert_staged_fraud_events
+from src.event import InvalidEventError
+
+# A derived table which some events are copied into as well as the audit table. write_event stores one event in its
+# own transaction and write_events stores a batch of events using the given cursor. write_staged_events stores the
+# staged events of an import which were flagged with the route's name. validate_details checks that an event's details
+# have every field the table needs, before the event gets anywhere near the database.
+EventRoute = namedtuple('EventRoute', [
+    'name',
+    'write_event',
+    'write_events',
+    'write_staged_events',
+    'validate_details',
+])
+
+
+def details_validator(route_name, required_fields):
+    """
+    Compiles a check that details contain all of required_fields, which raises an InvalidEventError naming the first
+    missing field if not.
+    """
+    required_field_set = frozenset(required_fields)
+
+    def validate_details(details):
+        if required_field_set.issubset(details):
+            return
+        for field in required_fields:
+            if field not in details:
+                raise InvalidEventError(
+                    'Invalid Message. Missing required {0} details field "{1}"'.format(route_name, field))
+
+    return validate_details
+
+
+BILLING_ROUTE = EventRoute(
+    'billing', write_billing_event_to_database, write_billing_events, insert_staged_billing_events, details_validator(
+        'billing', [
+            'pid',
+            'request_id',
+            'idp_entity_id',
+            'minimum_level_of_assurance',
+            'provided_level_of_assurance',
+            'transaction_entity_id',
+        ]))
+FRAUD_ROUTE = EventRoute(
+    'fraud', write_fraud_event_to_database, write_fraud_events, insert_staged_fraud_events, details_validator(
+        'fraud', [
+            'pid',
+            'request_id',
+            'idp_entity_id',
+            'idp_fraud_event_id',
+            'gpg45_status',
+            'transaction_entity_id',
+        ]))
+
+# The derived tables for each (event type, session event type). A new derived table only needs adding here.
+EVENT_ROUTES = {
+    ('session_event', 'idp_authn_succeeded'): (BILLING_ROUTE,),
+    ('session_event', 'fraud_detected'): (FRAUD_ROUTE,),
+}
+
+
+def routes_for(event):
+    return __routes_for(event.event_type, event.details)
+
+
+def validate_details(event_type, details):
+    """
+    Checks the details of an event which is still being mapped against every route it will be written to.
+    """
+    for route in __routes_for(event_type, details):
+        route.validate_details(details)
+
+
+def __routes_for(event_type, details):
+    # The details of an event which isn't routed can be anything, including null
+    if not isinstance(details, dict):
+        return ()
+    return EVENT_ROUTES.get((event_type, details.get('session_event_type')), ())
+
+
+def group_by_route(events):
+    """
+    Returns the events which go to each route, keeping the order of the events within each route. Events with no
+    derived tables are left out.
+    """
+    events_by_route = OrderedDict()
+    for event in events:
+        for route in routes_for(event):
+            events_by_route.setdefault(route, []).append(event)
+    return events_by_route
+
+
+def write_routed_events(events, cursor):
+    """
+    Writes a batch of events to their derived tables, with a single statement for each route.
+    """
+    for route, route_events in group_by_route(events).items():
+        route.write_events(route_events, cursor)
+
+
+def write_staged_routes(details_path, cursor):
+    """
+    Writes the staged events of an import to their derived tables, with a single statement for each route, and returns
+    the number of rows written to each.
+    """
+    routes = OrderedDict((route, None) for event_routes in EVENT_ROUTES.values() for route in event_routes)
+    return OrderedDict((route.name, route.write_staged_events(route.name, details_path, cursor)) for route in routes)
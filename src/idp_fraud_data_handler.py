@@ -2,14 +2,15 @@ import csv
 import logging
 import os
 import re
+from itertools import chain, islice
 
-import dateparser
-
-from src.common import get_database_password
-from src.database import create_db_connection, write_import_session, write_idp_fraud_event_to_database, \
-    update_session_as_validated, write_upload_error, RunInTransaction
+from src.common import process_s3_records
+from src.database import write_import_session, write_idp_fraud_event_to_database, \
+    write_idp_fraud_events_to_database, update_session_as_validated, write_upload_error, write_upload_errors, \
+    RunInTransaction
 from src.idp_fraud_event import IdpFraudEvent
-from src.s3 import fetch_object_tags, move_file, download_import_file
+from src.s3 import fetch_object_tags, move_file, stream_import_file
+from src.timestamp_parser import UploadTimestampParser, DATE_FORMAT_SAMPLE_SIZE
 from src.upload_session import UploadSession
 
 SUCCESS_FOLDER = 'success'
@@ -17,6 +18,14 @@ ERROR_FOLDER = 'error'
 DEFAULT_TIMEZONE = 'Europe/London'
 DEFAULT_HAS_HEADER = True
 DEFAULT_DIALECT = 'excel'
+# Stop at the first bad row, rolling back the whole upload and recording just that row's error
+ERROR_POLICY_STOP = 'stop'
+# Check every row, recording all of the errors, and store nothing if any row is bad
+ERROR_POLICY_REJECT_ALL = 'reject_all'
+# Check every row, recording all of the errors, and store the rows which are valid as a successful upload
+ERROR_POLICY_ACCEPT_VALID = 'accept_valid'
+DEFAULT_ERROR_POLICY = ERROR_POLICY_STOP
+IDP_FRAUD_EVENT_CHUNK_SIZE = 1000
 logger = logging.getLogger('idp_fraud_data_handler')
 logger.setLevel(logging.INFO)
 
@@ -31,47 +40,184 @@ def create_import_session(filename, idp_entity_id, userid, db_connection):
 
 
 def process_file(bucket, filename, upload_session, db_connection,
-                 has_header=DEFAULT_HAS_HEADER, dialect=DEFAULT_DIALECT, timezone=DEFAULT_TIMEZONE):
+                 has_header=DEFAULT_HAS_HEADER, dialect=DEFAULT_DIALECT, timezone=DEFAULT_TIMEZONE,
+                 error_policy=DEFAULT_ERROR_POLICY, date_format=None):
     logger.info('Processing data for IDP {}'.format(upload_session.idp_entity_id))
 
-    temp_file = download_import_file(bucket, filename)
+    with stream_import_file(bucket, filename) as csvfile:
+        timestamp_parser = UploadTimestampParser(timezone, date_format)
+        rows = detecting_date_format(numbered_rows(csv.reader(csvfile, dialect=dialect), has_header), timestamp_parser)
+        if error_policy == ERROR_POLICY_STOP:
+            return process_rows(rows, upload_session, db_connection, timestamp_parser)
+        return process_rows_with_savepoints(rows, upload_session, db_connection, timestamp_parser, error_policy)
+
+
+def numbered_rows(reader, has_header):
+    for row_number, row in enumerate(reader, start=1):
+        if has_header and row_number == 1:
+            continue
+        yield row_number, row
+
+
+def detecting_date_format(rows, timestamp_parser):
+    """
+    Works out the format of the timestamps once, from the first few rows, rather than for every row.
+    """
+    sample_rows = list(islice(rows, DATE_FORMAT_SAMPLE_SIZE))
+    timestamp_parser.detect_format([row[0] for _, row in sample_rows if row])
+    yield from chain(sample_rows, rows)
+
+
+def process_rows(rows, upload_session, db_connection, timestamp_parser):
+    """
+    Stores the rows in chunks inside a single transaction, rolling back the whole upload at the first bad row. A chunk
+    which can't be written is written again a row at a time, so that the row which caused the error is the one reported.
+    """
+    progress = {'row_number': 0}
     try:
-        with open(temp_file, newline='') as csvfile:
-            reader = csv.reader(csvfile, dialect=dialect)
-            errors_occurred = False
-            skip_row = has_header
-            row_number = 0
-            try:
-                with RunInTransaction(db_connection) as cursor:
-                    for row in reader:
-                        row_number = row_number + 1
-                        if skip_row:
-                            skip_row = False
-                            continue
-
-                        idp_fraud_event = parse_line(row, upload_session.idp_entity_id, timezone)
-                        id = write_idp_fraud_event_to_database(upload_session, idp_fraud_event, cursor, logger)
-                        if id:
-                            logger.info(
-                                'Successfully wrote IDP fraud event ID {} to database.'.format(idp_fraud_event.idp_event_id)
-                            )
+        with RunInTransaction(db_connection) as cursor:
+            chunk = []
+            for row_number, row in rows:
+                progress['row_number'] = row_number
+                chunk.append((row_number, parse_line(row, upload_session.idp_entity_id, timestamp_parser)))
+                if len(chunk) >= IDP_FRAUD_EVENT_CHUNK_SIZE:
+                    write_chunk_finding_bad_row(upload_session, chunk, cursor, progress)
+                    chunk = []
+            write_chunk_finding_bad_row(upload_session, chunk, cursor, progress)
+
+    except Exception as exception:
+        message = 'Failed to store IDP fraud event: {} (line {})'.format(exception, progress['row_number'])
+        logger.exception(message)
+        write_upload_error(upload_session, progress['row_number'], '**Row Exception**', message, db_connection)
+        return False
+
+    return True
 
+
+def process_rows_with_savepoints(rows, upload_session, db_connection, timestamp_parser, error_policy):
+    """
+    Stores each chunk of rows in its own savepoint, falling back to a savepoint per row when a chunk fails, so a bad
+    row is rolled back on its own and the rest of the file is still checked. Every failure is recorded, and depending
+    on the error policy either the valid rows are kept or the whole upload is rolled back. If the file can't be read to
+    the end, the whole upload is rolled back whatever the policy.
+    """
+    errors = []
+    read_errors = []
+    with RunInTransaction(db_connection) as cursor:
+        cursor.execute('SAVEPOINT idp_fraud_upload')
+        chunk = []
+        for row_number, row in read_until_error(rows, read_errors):
+            try:
+                chunk.append((row_number, parse_line(row, upload_session.idp_entity_id, timestamp_parser)))
             except Exception as exception:
-                message = 'Failed to store IDP fraud event: {} (line {})'.format(exception, row_number)
-                logger.exception(message)
-                write_upload_error(upload_session, row_number, '**Row Exception**', message, db_connection)
-                errors_occurred = True
+                errors.append(row_error(row_number, exception))
+                continue
+
+            if len(chunk) >= IDP_FRAUD_EVENT_CHUNK_SIZE:
+                errors.extend(write_chunk_with_savepoints(upload_session, chunk, cursor))
+                chunk = []
+        errors.extend(write_chunk_with_savepoints(upload_session, chunk, cursor))
+
+        if read_errors or (errors and error_policy == ERROR_POLICY_REJECT_ALL):
+            cursor.execute('ROLLBACK TO SAVEPOINT idp_fraud_upload')
+
+    errors.extend(read_errors)
+    if errors:
+        write_upload_errors(upload_session, sorted(errors), db_connection)
+
+    if read_errors:
+        return False
+    # The valid rows have been stored, so the upload has succeeded. Treating it as failed would invite uploading the
+    # file again, which would store them twice.
+    return not errors or error_policy == ERROR_POLICY_ACCEPT_VALID
+
+
+def read_until_error(rows, errors):
+    """
+    Yields the rows until the file can't be read any further, recording the error which stopped it against the whole
+    file. The file is decoded well ahead of the rows being parsed, so the error can't be put down to a row.
+    """
+    try:
+        yield from rows
+    except Exception as exception:
+        message = 'Failed to read the upload file: {}'.format(exception)
+        logger.exception(message)
+        errors.append((0, '**File Exception**', message))
+
 
-    finally:
-        os.remove(temp_file)
+def write_chunk(upload_session, idp_fraud_events, cursor):
+    write_idp_fraud_events_to_database(upload_session, idp_fraud_events, cursor, logger)
+    for idp_fraud_event in idp_fraud_events:
+        logger.info('Successfully wrote IDP fraud event ID {} to database.'.format(idp_fraud_event.idp_event_id))
 
-    return not errors_occurred
 
+def write_chunk_finding_bad_row(upload_session, numbered_idp_fraud_events, cursor, progress):
+    """
+    Writes a chunk of rows, and if that fails writes them again one at a time, so that the error is raised with
+    progress['row_number'] set to the row which caused it.
+    """
+    if not numbered_idp_fraud_events:
+        return
 
-def parse_line(row, idp_entity_id, timezone=DEFAULT_TIMEZONE):
+    cursor.execute('SAVEPOINT idp_fraud_event_chunk')
+    try:
+        write_chunk(upload_session, [idp_fraud_event for _, idp_fraud_event in numbered_idp_fraud_events], cursor)
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT idp_fraud_event_chunk')
+        logger.warning('Failed to store a chunk of {} IDP fraud events - storing each row on its own'.format(
+            len(numbered_idp_fraud_events)))
+        for row_number, idp_fraud_event in numbered_idp_fraud_events:
+            progress['row_number'] = row_number
+            write_idp_fraud_event_to_database(upload_session, idp_fraud_event, cursor, logger)
+            logger.info('Successfully wrote IDP fraud event ID {} to database.'.format(idp_fraud_event.idp_event_id))
+        return
+
+    cursor.execute('RELEASE SAVEPOINT idp_fraud_event_chunk')
+
+
+def write_chunk_with_savepoints(upload_session, numbered_idp_fraud_events, cursor):
+    if not numbered_idp_fraud_events:
+        return []
+
+    cursor.execute('SAVEPOINT idp_fraud_event_chunk')
+    try:
+        write_chunk(upload_session, [idp_fraud_event for _, idp_fraud_event in numbered_idp_fraud_events], cursor)
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT idp_fraud_event_chunk')
+        logger.warning('Failed to store a chunk of {} IDP fraud events - storing each row on its own'.format(
+            len(numbered_idp_fraud_events)))
+        return write_rows_with_savepoints(upload_session, numbered_idp_fraud_events, cursor)
+
+    cursor.execute('RELEASE SAVEPOINT idp_fraud_event_chunk')
+    return []
+
+
+def write_rows_with_savepoints(upload_session, numbered_idp_fraud_events, cursor):
+    errors = []
+    for row_number, idp_fraud_event in numbered_idp_fraud_events:
+        cursor.execute('SAVEPOINT idp_fraud_event_row')
+        try:
+            write_idp_fraud_event_to_database(upload_session, idp_fraud_event, cursor, logger)
+        except Exception as exception:
+            cursor.execute('ROLLBACK TO SAVEPOINT idp_fraud_event_row')
+            errors.append(row_error(row_number, exception))
+            continue
+
+        cursor.execute('RELEASE SAVEPOINT idp_fraud_event_row')
+        logger.info('Successfully wrote IDP fraud event ID {} to database.'.format(idp_fraud_event.idp_event_id))
+    return errors
+
+
+def row_error(row_number, exception):
+    message = 'Failed to store IDP fraud event: {} (line {})'.format(exception, row_number)
+    logger.exception(message)
+    return row_number, '**Row Exception**', message
+
+
+def parse_line(row, idp_entity_id, timestamp_parser):
     return IdpFraudEvent(
         idp_entity_id=idp_entity_id,
-        timestamp=dateparser.parse(row[0], settings={'TIMEZONE': timezone}),
+        timestamp=timestamp_parser.parse(row[0]),
         idp_event_id=row[1],
         fid_code=row[2],
         contra_indicators=re.split(',|\n|\r\n', row[3]) if row[3].strip() else [],
@@ -93,33 +239,42 @@ def move_to_success(bucket, filename):
 def idp_fraud_data_events(event, __):
     dsn = os.environ['DB_CONNECTION_STRING']
 
-    db_connection = create_db_connection(dsn, get_database_password(dsn))
-    logger.info('Created connection to DB')
-
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        filename = record['s3']['object']['key']
-
-        tags = fetch_object_tags(bucket, filename)
-        idp_entity_id = tags['idp']
-        username = tags['username']
-
-        timezone = DEFAULT_TIMEZONE
-        dialect = DEFAULT_DIALECT
-        has_header = DEFAULT_HAS_HEADER
-
-        if 'timezone' in tags:
-            timezone = tags['timezone']
-        if 'dialect' in tags:
-            dialect = tags['dialect']
-        if 'has_header' in tags:
-            has_header = tags['has_header'].lower() in ['true', '1', 'y', 'yes']
-
-        upload_session = create_import_session(filename, idp_entity_id, username, db_connection)
-        if process_file(bucket, filename, upload_session, db_connection, has_header, dialect, timezone):
-            logger.info("Processing successful")
-            update_session_as_validated(upload_session, db_connection)
-            move_to_success(bucket, filename)
-        else:
-            logger.warning("Processing Failed")
-            move_to_error(bucket, filename)
+    process_s3_records(event['Records'], process_record, dsn, logger)
+
+
+def process_record(record, db_connection):
+    bucket = record['s3']['bucket']['name']
+    filename = record['s3']['object']['key']
+
+    tags = fetch_object_tags(bucket, filename)
+    idp_entity_id = tags['idp']
+    username = tags['username']
+
+    timezone = DEFAULT_TIMEZONE
+    dialect = DEFAULT_DIALECT
+    has_header = DEFAULT_HAS_HEADER
+    error_policy = DEFAULT_ERROR_POLICY
+    date_format = None
+
+    if 'timezone' in tags:
+        timezone = tags['timezone']
+    if 'dialect' in tags:
+        dialect = tags['dialect']
+    if 'has_header' in tags:
+        has_header = tags['has_header'].lower() in ['true', '1', 'y', 'yes']
+    if tags.get('error_policy') in [ERROR_POLICY_STOP, ERROR_POLICY_REJECT_ALL, ERROR_POLICY_ACCEPT_VALID]:
+        error_policy = tags['error_policy']
+    elif 'error_policy' in tags:
+        logger.warning('Unknown error policy "{}" - using "{}"'.format(tags['error_policy'], error_policy))
+    if 'date_format' in tags:
+        date_format = tags['date_format']
+
+    upload_session = create_import_session(filename, idp_entity_id, username, db_connection)
+    if process_file(bucket, filename, upload_session, db_connection, has_header, dialect, timezone, error_policy,
+                    date_format):
+        logger.info("Processing successful")
+        update_session_as_validated(upload_session, db_connection)
+        move_to_success(bucket, filename)
+    else:
+        logger.warning("Processing Failed")
+        move_to_error(bucket, filename)
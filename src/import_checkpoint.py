@@ -0,0 +1,6 @@
+from collections import namedtuple
+
+# How far through an import file the import has got. byte_offset is where the line after line_number starts, so a
+# retry can carry on from there. The ETag ties the checkpoint to one version of the file.
+ImportCheckpoint = namedtuple('ImportCheckpoint', ['bucket', 'key', 'etag', 'byte_offset', 'line_number'])
+ImportCheckpoint.__new__.__defaults__ = (0, 0)
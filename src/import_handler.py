@@ -1,12 +1,26 @@
-import json
 import logging
 import os
+from itertools import chain, islice
 
-from src.common import get_database_password
-from src.database import create_db_connection, write_audit_event_to_database, \
-    write_billing_event_to_database, write_fraud_event_to_database
+from src import json_codec
+from src.common import process_s3_records
+from src.database import write_audit_events, RunInTransaction, create_import_staging_table, \
+    copy_to_import_staging_table, insert_staged_audit_events, read_import_checkpoint, write_import_checkpoint, \
+    delete_import_checkpoint
 from src.event_mapper import event_from_json_object
-from src.s3 import fetch_import_file, delete_import_file
+from src.event_routing import routes_for, write_routed_events, write_staged_routes
+from src.s3 import fetch_import_file_version, fetch_import_file, delete_import_file
+
+DEFAULT_IMPORT_BATCH_SIZE = 1000
+DEFAULT_IMPORT_STAGED_BATCH_SIZE = 100000
+# Store the lines in batches of IMPORT_BATCH_SIZE lines
+IMPORT_MODE_BATCHED = 'batched'
+# Copy batches of IMPORT_STAGED_BATCH_SIZE lines into a staging table and store each batch with a few set-based
+# statements, for large backfills
+IMPORT_MODE_STAGED = 'staged'
+DEFAULT_IMPORT_MODE = IMPORT_MODE_BATCHED
+# Where the details are in each line of an import file
+IMPORT_DETAILS_PATH = ('document', 'details')
 
 
 def import_events(event, __):
@@ -15,29 +29,197 @@ def import_events(event, __):
 
     dsn = os.environ['DB_CONNECTION_STRING']
 
-    db_connection = create_db_connection(dsn, get_database_password(dsn))
-    logger.info('Created connection to DB')
+    import_mode = os.environ.get('IMPORT_MODE', DEFAULT_IMPORT_MODE)
+    if import_mode not in [IMPORT_MODE_BATCHED, IMPORT_MODE_STAGED]:
+        logger.warning('Unknown import mode "{0}" - using "{1}"'.format(import_mode, DEFAULT_IMPORT_MODE))
+        import_mode = DEFAULT_IMPORT_MODE
 
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        filename = record['s3']['object']['key']
+    def import_record(record, db_connection):
+        __import_file(record['s3']['bucket']['name'], record['s3']['object']['key'], import_mode, db_connection,
+                      logger)
 
-        iterable = fetch_import_file(bucket, filename)
+    process_s3_records(event['Records'], import_record, dsn, logger)
+
+
+def __import_file(bucket, filename, import_mode, db_connection, logger):
+    etag, size = fetch_import_file_version(bucket, filename)
+    checkpoint = read_import_checkpoint(bucket, filename, etag, db_connection)
+    if checkpoint.line_number:
+        logger.info('Resuming import of {0} after line {1}'.format(filename, checkpoint.line_number))
+
+    if import_mode == IMPORT_MODE_STAGED:
+        __import_lines_staged(bucket, filename, size, checkpoint, db_connection, logger)
+    else:
+        __import_lines_in_batches(__numbered_lines(bucket, filename, checkpoint, size), checkpoint, db_connection,
+                                  logger)
+
+    delete_import_checkpoint(checkpoint, db_connection)
+    delete_import_file(bucket, filename)
+
+
+def __numbered_lines(bucket, filename, checkpoint, size):
+    """
+    Yields (line number, line, offset of the next line) for each line after the checkpoint.
+    """
+    if checkpoint.byte_offset >= size:
+        # Every line was stored, but the file wasn't deleted
+        return
+    lines = fetch_import_file(bucket, filename, checkpoint.etag, checkpoint.byte_offset)
+    for line_number, (line, next_offset) in enumerate(lines, start=checkpoint.line_number + 1):
+        yield line_number, line, next_offset
 
-        for line in iterable:
-            try:
-                message_envelope = json.loads(line)
-                event = event_from_json_object(message_envelope['document'])
 
-                if write_audit_event_to_database(event, db_connection):
-                    if (event.event_type == 'session_event'
-                            and event.details.get('session_event_type') == 'idp_authn_succeeded'):
-                        write_billing_event_to_database(event, db_connection)
-                    if (event.event_type == 'session_event'
-                            and event.details.get('session_event_type') == 'fraud_detected'):
-                        write_fraud_event_to_database(event, db_connection)
+def __line_batches(numbered_lines, batch_size):
+    """
+    Splits the lines into batches without reading ahead, so a batch can be streamed. Each batch must be used up before
+    the next is taken.
+    """
+    numbered_lines = iter(numbered_lines)
+    for first_line in numbered_lines:
+        yield chain([first_line], islice(numbered_lines, max(batch_size, 1) - 1))
 
+
+def __import_lines_in_batches(numbered_lines, checkpoint, db_connection, logger):
+    """
+    Stores the lines in batches of IMPORT_BATCH_SIZE, and returns the number of events inserted and the number of lines
+    rejected.
+    """
+    batch_size = int(os.environ.get('IMPORT_BATCH_SIZE', DEFAULT_IMPORT_BATCH_SIZE))
+
+    inserted = 0
+    rejected = 0
+    for lines in __line_batches(numbered_lines, batch_size):
+        events = []
+        for line_number, line, next_offset in lines:
+            checkpoint = checkpoint._replace(byte_offset=next_offset, line_number=line_number)
+            try:
+                events.append(__event_from_line(line))
             except Exception as exception:
+                rejected += 1
                 logger.exception('Failed to store message{}'.format(exception))
 
-        delete_import_file(bucket, filename)
+        batch_inserted, batch_rejected = __store_batch(events, checkpoint, db_connection, logger)
+        inserted += batch_inserted
+        rejected += batch_rejected
+
+    return inserted, rejected
+
+
+def __import_lines_staged(bucket, filename, size, checkpoint, db_connection, logger):
+    """
+    Copies the valid lines of each batch into a staging table, then stores them with a statement per table in the
+    same transaction. Duplicates are skipped by the database rather than raising an error for each line.
+
+    A batch which the database refuses is read from the file again and stored in batches of IMPORT_BATCH_SIZE, so
+    only the lines which can't be stored are lost.
+    """
+    batch_size = int(os.environ.get('IMPORT_STAGED_BATCH_SIZE', DEFAULT_IMPORT_STAGED_BATCH_SIZE))
+
+    progress = {'line_number': checkpoint.line_number, 'byte_offset': checkpoint.byte_offset, 'staged': 0,
+                'rejected': 0}
+    inserted = 0
+    for lines in __line_batches(__numbered_lines(bucket, filename, checkpoint, size), batch_size):
+        batch_checkpoint = checkpoint._replace(byte_offset=progress['byte_offset'], line_number=progress['line_number'])
+        batch_progress = dict(progress)
+        # noinspection PyBroadException
+        try:
+            with RunInTransaction(db_connection) as cursor:
+                create_import_staging_table(cursor)
+                copy_to_import_staging_table(__staged_events(lines, batch_progress, logger), cursor)
+                batch_inserted = insert_staged_audit_events(IMPORT_DETAILS_PATH, cursor)
+                write_staged_routes(IMPORT_DETAILS_PATH, cursor)
+                write_import_checkpoint(checkpoint._replace(
+                    byte_offset=batch_progress['byte_offset'], line_number=batch_progress['line_number']), cursor)
+        except Exception:
+            logger.exception('Failed to store the staged batch of lines after line {0} - storing it in smaller '
+                             'batches'.format(batch_checkpoint.line_number))
+            # The batch may not have been read to the end before the error, and what was read went into the failed
+            # COPY, so it is read from the file again
+            for line_number, _, next_offset in lines:
+                batch_progress['line_number'] = line_number
+                batch_progress['byte_offset'] = next_offset
+            line_count = batch_progress['line_number'] - batch_checkpoint.line_number
+            batch_inserted, batch_rejected = __import_lines_in_batches(
+                islice(__numbered_lines(bucket, filename, batch_checkpoint, size), line_count), batch_checkpoint,
+                db_connection, logger)
+            batch_progress['staged'] = progress['staged'] + line_count - batch_rejected
+            batch_progress['rejected'] = progress['rejected'] + batch_rejected
+
+        inserted += batch_inserted
+        progress = batch_progress
+
+    logger.info('Imported {0}: {1} inserted, {2} duplicates, {3} rejected'.format(
+        filename, inserted, progress['staged'] - inserted, progress['rejected']))
+
+
+def __staged_events(lines, progress, logger):
+    for line_number, line, next_offset in lines:
+        progress['line_number'] = line_number
+        progress['byte_offset'] = next_offset
+        try:
+            event = __event_from_line(line)
+        except Exception as exception:
+            progress['rejected'] += 1
+            logger.exception('Failed to store message{}'.format(exception))
+            continue
+
+        progress['staged'] += 1
+        yield line_number, event, [route.name for route in routes_for(event)]
+
+
+def __event_from_line(line):
+    raw_json = line.decode('utf-8')
+    message_envelope = json_codec.loads(raw_json)
+    return event_from_json_object(message_envelope['document'], raw_json, IMPORT_DETAILS_PATH)
+
+
+def __store_batch(events, checkpoint, db_connection, logger):
+    """
+    Stores a batch of events in a single transaction, along with the checkpoint at the end of the batch. If the batch
+    cannot be committed it is written again with each event in its own savepoint, so one bad line does not stop the
+    rest of the batch from being stored. Returns the number of events inserted and the number which couldn't be stored.
+    """
+    # noinspection PyBroadException
+    try:
+        with RunInTransaction(db_connection) as cursor:
+            inserted = __write_events(events, cursor)
+            write_import_checkpoint(checkpoint, cursor)
+        return inserted, 0
+    except Exception:
+        logger.warning('Failed to store a batch of {0} events - storing each event on its own'.format(len(events)))
+        return __store_batch_with_savepoints(events, checkpoint, db_connection, logger)
+
+
+def __store_batch_with_savepoints(events, checkpoint, db_connection, logger):
+    inserted = 0
+    rejected = 0
+    # noinspection PyBroadException
+    try:
+        with RunInTransaction(db_connection) as cursor:
+            for event in events:
+                cursor.execute('SAVEPOINT import_event')
+                try:
+                    inserted += __write_events([event], cursor)
+                except Exception as exception:
+                    cursor.execute('ROLLBACK TO SAVEPOINT import_event')
+                    rejected += 1
+                    logger.exception('Failed to store message{}'.format(exception))
+                    continue
+                cursor.execute('RELEASE SAVEPOINT import_event')
+            write_import_checkpoint(checkpoint, cursor)
+    except Exception:
+        logger.exception('Failed to commit a batch of {0} events'.format(len(events)))
+        return 0, len(events)
+
+    return inserted, rejected
+
+
+def __write_events(events, cursor):
+    """
+    Returns the number of events which were new to the audit table.
+    """
+    # Only events which are new to the audit table are written to the derived tables, as they were when each line was
+    # stored on its own
+    stored = write_audit_events(events, cursor)
+    write_routed_events([event for event, is_stored in zip(events, stored) if is_stored], cursor)
+    return sum(stored)
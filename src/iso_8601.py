@@ -0,0 +1,29 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+# The shapes of ISO 8601 timestamp our services send, e.g. 2018-02-10T12:00:00Z or 2018-02-10T12:00:00.123+01:00
+ISO_8601_TIMESTAMP = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:[.,](\d+))?(?:(Z)|([+-])(\d{2}):?(\d{2}))?')
+
+
+def parse_iso_8601_timestamp(timestamp):
+    """
+    Parses the timestamp strictly, to the same result as dateutil would give, or returns None if it isn't in one of
+    the shapes matched by ISO_8601_TIMESTAMP. As with dateutil, a timestamp without an offset is in local time.
+    """
+    match = ISO_8601_TIMESTAMP.fullmatch(timestamp)
+    if match is None:
+        return None
+
+    year, month, day, hour, minute, second, fraction, utc, sign, offset_hours, offset_minutes = match.groups()
+    if utc:
+        tzinfo = timezone.utc
+    elif sign:
+        offset = timedelta(hours=int(offset_hours), minutes=int(offset_minutes))
+        tzinfo = timezone(-offset if sign == '-' else offset)
+    else:
+        tzinfo = None
+
+    # dateutil keeps at most microseconds, dropping any further digits
+    microsecond = int(fraction[:6].ljust(6, '0')) if fraction else 0
+    return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second), microsecond, tzinfo)
@@ -0,0 +1,47 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The types orjson writes exactly as the json module does. Floats are left out, as orjson writes NaN and infinity as
+# null and an exponent without its sign or leading zero.
+PLAIN_JSON_SCALAR_TYPES = frozenset([str, int, bool, type(None)])
+
+
+def loads(json_text):
+    if orjson is not None:
+        try:
+            return orjson.loads(json_text)
+        except orjson.JSONDecodeError:
+            # orjson is stricter than the json module (NaN, integers over 64 bits), so a document it rejects is given
+            # to json as well, which either accepts it or raises the error we've always raised
+            pass
+    return json.loads(json_text)
+
+
+def dumps(value):
+    """
+    Serialises value as compact JSON text, the same whether or not orjson is installed. orjson is only given values it
+    writes exactly as the json module does, so anything else - such as a float, which orjson writes as null if it isn't
+    finite, or a datetime, which json refuses - is written or rejected by json as it always has been.
+    """
+    if orjson is not None and __is_plain_json(value):
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:
+            # orjson only takes integers up to 64 bits
+            pass
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+
+
+def __is_plain_json(value):
+    value_type = type(value)
+    if value_type in PLAIN_JSON_SCALAR_TYPES:
+        return True
+    if value_type is dict:
+        return all(type(key) is str and __is_plain_json(item) for key, item in value.items())
+    if value_type is list or value_type is tuple:
+        return all(__is_plain_json(item) for item in value)
+    return False
@@ -1,9 +1,10 @@
-import boto3
 import base64
 
+from src.aws import get_client
+
 
 def decrypt(encrypted_key):
-    kms_client = boto3.client('kms')
+    kms_client = get_client('kms')
     binary_data = base64.b64decode(encrypted_key)
     response = kms_client.decrypt(CiphertextBlob=binary_data)
     return response['Plaintext']
@@ -1,46 +1,111 @@
+import io
 import os
-import tempfile
 
-import boto3
+from src.aws import get_client
+
+IMPORT_FILE_BUFFER_SIZE = 256 * 1024
 
 
 def fetch_decryption_key():
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     bucket_name = os.environ['DECRYPTION_KEY_BUCKET_NAME']
     filename = os.environ['DECRYPTION_KEY_FILE_NAME']
     response = s3_client.get_object(Bucket=bucket_name, Key=filename)
     return response['Body'].read()
 
 
-def fetch_import_file(bucket_name, filename):
-    s3_client = boto3.client('s3')
+def fetch_import_file_version(bucket_name, filename):
+    """
+    Returns the ETag and size of an object.
+    """
+    s3_client = get_client('s3')
+    response = s3_client.head_object(Bucket=bucket_name, Key=filename)
+    return response['ETag'], response['ContentLength']
+
+
+def fetch_import_file(bucket_name, filename, etag, start_offset=0):
+    """
+    Yields the lines of the given version of an object from start_offset on, with a ranged GET if that isn't the start
+    of the object. Each line comes with the offset just past its line ending, where the next line starts.
+    """
+    s3_client = get_client('s3')
+    request = {'Bucket': bucket_name, 'Key': filename, 'IfMatch': etag}
+    if start_offset:
+        request['Range'] = 'bytes={0}-'.format(start_offset)
+    response = s3_client.get_object(**request)
+    return iter_lines_with_offsets(response['Body'], start_offset)
+
+
+def iter_lines_with_offsets(body, start_offset=0, chunk_size=IMPORT_FILE_BUFFER_SIZE):
+    """
+    Splits a StreamingBody into lines in the same way as its iter_lines, but also keeps track of where each line ends.
+    """
+    offset = start_offset
+    pending = b''
+    while True:
+        chunk = body.read(chunk_size)
+        if not chunk:
+            break
+        # The last piece is held back even if it ends in a line ending, in case it is a \r followed by a \n
+        lines = (pending + chunk).splitlines(True)
+        pending = lines.pop()
+        for line in lines:
+            offset += len(line)
+            yield line.splitlines()[0], offset
+
+    if pending:
+        yield pending.splitlines()[0], offset + len(pending)
+
+
+def stream_import_file(bucket_name, filename, encoding='utf-8'):
+    """
+    Opens an object as a text file which is read straight from the S3 response as it is consumed, rather than being
+    downloaded to disk first. Lines are split the same way as a file opened with newline='', as csv.reader expects.
+    """
+    s3_client = get_client('s3')
     response = s3_client.get_object(Bucket=bucket_name, Key=filename)
-    return response['Body'].iter_lines()
+    return io.TextIOWrapper(
+        io.BufferedReader(StreamingBodyReader(response['Body']), IMPORT_FILE_BUFFER_SIZE),
+        encoding=encoding,
+        newline=''
+    )
+
+
+class StreamingBodyReader(io.RawIOBase):
+    """
+    Adapts a botocore StreamingBody to a raw binary stream so it can be buffered and decoded incrementally.
+    """
+
+    def __init__(self, body):
+        self.__body = body
 
+    def readable(self):
+        return True
 
-def download_import_file(bucket_name, filename):
-    s3_client = boto3.client('s3')
-    fd, temp_file_name = tempfile.mkstemp()
-    with open(temp_file_name, 'wb') as data:
-        s3_client.download_fileobj(bucket_name, filename, data)
+    def readinto(self, buffer):
+        data = self.__body.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
 
-    os.close(fd)
-    return temp_file_name
+    def close(self):
+        if not self.closed:
+            self.__body.close()
+        super().close()
 
 
 def delete_import_file(bucket_name, filename):
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     s3_client.delete_object(Bucket=bucket_name, Key=filename)
 
 
 def fetch_object_tags(bucket_name, filename):
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     response = s3_client.get_object_tagging(Bucket=bucket_name, Key=filename)
     return {tag['Key']: tag['Value'] for tag in response['TagSet']}
 
 
 def move_file(bucket_name, filename, new_prefix):
-    s3_client = boto3.client('s3')
+    s3_client = get_client('s3')
     new_filename = os.path.basename(filename)
 
     s3_client.copy_object(Bucket=bucket_name,
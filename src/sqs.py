@@ -1,15 +1,225 @@
-def fetch_single_message(sqs_client, queue_url):
+import threading
+from collections import deque
+from logging import getLogger
+from queue import Queue, Empty
+
+MAX_NUMBER_OF_MESSAGES = 10  # The most SQS will return or accept in a single call
+VISIBILITY_TIMEOUT_SECONDS = 300  # 5 min timeout - any failed messages can be picked up by a later lambda
+DEFAULT_PREFETCH_DEPTH = 1
+MAX_WAIT_TIME_SECONDS = 20  # The longest SQS will wait for messages to arrive in a single receive
+MAX_DELETE_ATTEMPTS = 3
+DEADLINE_FLUSH_MARGIN_MILLIS = 10000
+
+
+# By default don't wait for messages - if there aren't any left, then the lambda's job is done. A long running worker
+# waits for up to MAX_WAIT_TIME_SECONDS instead, so it isn't polling an empty queue over and over.
+def fetch_message_batch(sqs_client, queue_url, max_number_of_messages=MAX_NUMBER_OF_MESSAGES, wait_time_seconds=0):
     response = sqs_client.receive_message(
         QueueUrl=queue_url,
-        MaxNumberOfMessages=1,
-        VisibilityTimeout=300,  # 5 min timeout - any failed messages can be picked up by a later lambda
-        WaitTimeSeconds=0,  # Don't wait for messages - if there aren't any left, then this lambda's job is done
+        MaxNumberOfMessages=max_number_of_messages,
+        VisibilityTimeout=VISIBILITY_TIMEOUT_SECONDS,
+        WaitTimeSeconds=wait_time_seconds,
     )
-    return response['Messages'][0] if 'Messages' in response and response['Messages'] else None
+    return response['Messages'] if 'Messages' in response else []
 
 
-def delete_message(sqs_client, queue_url, message):
-    sqs_client.delete_message(
-        QueueUrl=queue_url,
-        ReceiptHandle=message['ReceiptHandle']
-    )
+def release_messages(sqs_client, queue_url, messages):
+    """
+    Makes messages which were received but won't be processed visible on the queue again straight away, rather than
+    when their visibility timeout runs out.
+    """
+    for start in range(0, len(messages), MAX_NUMBER_OF_MESSAGES):
+        batch = messages[start:start + MAX_NUMBER_OF_MESSAGES]
+        response = sqs_client.change_message_visibility_batch(
+            QueueUrl=queue_url,
+            Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+                     for index, message in enumerate(batch)]
+        )
+        for failure in response.get('Failed', []):
+            getLogger('event-recorder').warning('Failed to release SQS message ID {0}: {1}'.format(
+                batch[int(failure['Id'])]['MessageId'], failure.get('Message', failure['Code'])))
+
+
+class PrefetchingReceiver:
+    """
+    Receives batches of messages on a background thread, so the next batch is already on its way while the current
+    one is being stored. Iterating over the receiver yields messages in the order they were received, and ends once
+    the queue has been found empty.
+
+    At most prefetch_depth batches are held ahead of the caller. Prefetched messages are already invisible on the
+    queue and their visibility timeout is running, so the depth should stay small - with the default of one batch a
+    prefetched message waits no longer than it takes to store the batch before it. A depth of 0 turns prefetching
+    off and each batch is received only when the caller needs it.
+
+    Each receive waits up to wait_time_seconds for messages to arrive, so closing the receiver can take that long.
+    """
+
+    __END = object()
+
+    def __init__(self, sqs_client, queue_url, prefetch_depth=DEFAULT_PREFETCH_DEPTH, wait_time_seconds=0):
+        self.__sqs_client = sqs_client
+        self.__queue_url = queue_url
+        self.__prefetch_depth = prefetch_depth
+        self.__wait_time_seconds = wait_time_seconds
+        self.__batches = Queue()
+        # A batch is only received once there is room for it, so nothing is taken from the queue to wait in memory
+        self.__free_slots = threading.Semaphore(max(prefetch_depth, 1))
+        self.__stopping = threading.Event()
+        self.__thread = None
+        self.__current_batch = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __iter__(self):
+        if self.__prefetch_depth <= 0:
+            while not self.__stopping.is_set():
+                messages = fetch_message_batch(
+                    self.__sqs_client, self.__queue_url, wait_time_seconds=self.__wait_time_seconds)
+                if not messages:
+                    return
+                yield from self.__hand_over(messages)
+            return
+
+        if self.__thread is None:
+            self.__thread = threading.Thread(target=self.__receive, daemon=True)
+            self.__thread.start()
+
+        while True:
+            batch = self.__batches.get()
+            if batch is self.__END:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            self.__free_slots.release()
+            yield from self.__hand_over(batch)
+
+    def close(self):
+        """
+        Stops receiving and returns any messages which were received but not handed to the caller.
+        """
+        self.__stopping.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+        messages = list(self.__current_batch)
+        self.__current_batch.clear()
+        while True:
+            try:
+                batch = self.__batches.get_nowait()
+            except Empty:
+                return messages
+            if isinstance(batch, list):
+                messages.extend(batch)
+
+    def __hand_over(self, batch):
+        # The rest of the batch is kept where close can find it if the caller stops part way through
+        self.__current_batch.extend(batch)
+        while self.__current_batch:
+            yield self.__current_batch.popleft()
+
+    def __receive(self):
+        # noinspection PyBroadException
+        try:
+            while self.__wait_for_free_slot():
+                messages = fetch_message_batch(
+                    self.__sqs_client, self.__queue_url, wait_time_seconds=self.__wait_time_seconds)
+                if not messages:
+                    break
+                self.__batches.put(messages)
+        except Exception as error:
+            self.__batches.put(error)
+            return
+        self.__batches.put(self.__END)
+
+    def __wait_for_free_slot(self):
+        while not self.__stopping.is_set():
+            if self.__free_slots.acquire(timeout=0.1):
+                return True
+        return False
+
+
+class MessageDeleter:
+    """
+    Collects the messages which have been stored and deletes them from the queue using DeleteMessageBatch.
+
+    Pending messages are flushed when a full batch has been collected, when the lambda is close to its deadline,
+    when flush is called and when the deleter is used as a context manager and the block exits.
+    """
+
+    def __init__(self, sqs_client, queue_url, context=None):
+        self.__sqs_client = sqs_client
+        self.__queue_url = queue_url
+        self.__context = context
+        self.__pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.flush()
+
+    def add(self, message, event_id):
+        self.__pending.append((message, event_id))
+        if len(self.__pending) >= MAX_NUMBER_OF_MESSAGES or self.__is_near_deadline():
+            self.flush()
+
+    def flush(self):
+        pending = self.__pending
+        self.__pending = []
+        for start in range(0, len(pending), MAX_NUMBER_OF_MESSAGES):
+            self.__delete_batch(pending[start:start + MAX_NUMBER_OF_MESSAGES])
+
+    def __delete_batch(self, batch):
+        entries = {str(index): (message, event_id) for index, (message, event_id) in enumerate(batch)}
+        failures = []
+        for _ in range(MAX_DELETE_ATTEMPTS):
+            # noinspection PyBroadException
+            try:
+                response = self.__sqs_client.delete_message_batch(
+                    QueueUrl=self.__queue_url,
+                    Entries=[{'Id': entry_id, 'ReceiptHandle': message['ReceiptHandle']}
+                             for entry_id, (message, _) in entries.items()]
+                )
+            except Exception as error:
+                # botocore has already retried the call, so give up on the batch rather than stop storing events
+                getLogger('event-recorder').exception('Failed to delete a batch of {0} events from queue'.format(
+                    len(entries)))
+                failures = [{'Id': entry_id, 'Code': type(error).__name__, 'Message': str(error)}
+                            for entry_id in entries]
+                break
+
+            successful_ids = {success['Id'] for success in response.get('Successful', [])}
+            for entry_id, (_, event_id) in entries.items():
+                if entry_id in successful_ids:
+                    getLogger('event-recorder').info('Deleted event from queue with ID: {0}'.format(event_id))
+
+            # Only the entries which failed through no fault of the request are retried - a retry would fail for the
+            # ones which were deleted, and for ones such as an expired receipt handle.
+            failures = []
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    self.__log_delete_failure(entries[failure['Id']], failure)
+                else:
+                    failures.append(failure)
+            entries = {failure['Id']: entries[failure['Id']] for failure in failures}
+            if not entries:
+                return
+
+        for failure in failures:
+            self.__log_delete_failure(entries[failure['Id']], failure)
+
+    @staticmethod
+    def __log_delete_failure(entry, failure):
+        message, event_id = entry
+        # The event has been stored, so the message will be recorded as a duplicate when it becomes visible again.
+        getLogger('event-recorder').warning(
+            'Failed to delete event {0} from queue, SQS message ID {1}: {2}'.format(
+                event_id, message['MessageId'], failure.get('Message', failure['Code'])))
+
+    def __is_near_deadline(self):
+        return self.__context is not None and \
+            self.__context.get_remaining_time_in_millis() < DEADLINE_FLUSH_MARGIN_MILLIS
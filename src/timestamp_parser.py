@@ -0,0 +1,129 @@
+from datetime import datetime
+
+import dateparser
+import pytz
+
+from src.iso_8601 import parse_iso_8601_timestamp
+
+# How many rows from the start of an upload are used to work out the format of its timestamps
+DATE_FORMAT_SAMPLE_SIZE = 10
+
+# Formats for timestamps without an offset, which dateparser returns as they are, without a timezone
+NAIVE_DATE_FORMATS = [
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d',
+]
+
+# Formats where the day and month can be swapped. A timestamp in which either order would make a valid date is left to
+# dateparser, so it is read exactly as it was before formats were detected.
+DAY_MONTH_DATE_FORMATS = [
+    '%d/%m/%Y %H:%M',
+    '%d/%m/%Y %H:%M:%S',
+    '%d/%m/%Y',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y',
+]
+
+
+class UploadTimestampParser:
+    """
+    Parses the timestamps in one upload to the same datetimes as dateparser.parse with the upload's timezone, without
+    paying for dateparser's language and format detection on every row.
+
+    The format is either given, as a strptime format, or detected from a sample of the upload's timestamps by trying
+    each known format against what dateparser makes of the sample. A timestamp which doesn't match the format is still
+    parsed with dateparser.
+    """
+
+    def __init__(self, timezone, date_format=None):
+        self.__settings = {'TIMEZONE': timezone}
+        self.__converter = None
+        try:
+            self.__timezone = pytz.timezone(timezone)
+        except pytz.UnknownTimeZoneError:
+            # Leave every timestamp to dateparser, so it reports the bad timezone for each row as it always has
+            self.__timezone = None
+            return
+        if date_format:
+            self.__converter = self.__strptime_converter(date_format, False)
+
+    def detect_format(self, sample_timestamps):
+        if self.__converter is not None or self.__timezone is None:
+            return
+
+        expected = [(timestamp, self.__parse_with_dateparser(timestamp)) for timestamp in sample_timestamps]
+        for converter in self.__candidate_converters():
+            if self.__matches(converter, expected):
+                self.__converter = converter
+                return
+
+    def parse(self, timestamp):
+        if self.__converter is not None:
+            try:
+                date_time = self.__converter(timestamp)
+            except ValueError:
+                date_time = None
+            if date_time is not None:
+                return date_time
+
+        return dateparser.parse(timestamp, settings=self.__settings)
+
+    def __parse_with_dateparser(self, timestamp):
+        # noinspection PyBroadException
+        try:
+            return dateparser.parse(timestamp, settings=self.__settings)
+        except Exception:
+            # The row's own parse will report the problem - here it just can't help to pick a format
+            return None
+
+    def __candidate_converters(self):
+        yield self.__iso_8601_converter
+        for date_format in NAIVE_DATE_FORMATS:
+            yield self.__strptime_converter(date_format, False)
+        for date_format in DAY_MONTH_DATE_FORMATS:
+            yield self.__strptime_converter(date_format, True)
+
+    @staticmethod
+    def __matches(converter, expected):
+        """
+        A converter matches if it gives dateparser's result for every sample timestamp it can read, and can read at
+        least one of them.
+        """
+        matched = False
+        for timestamp, expected_date_time in expected:
+            if expected_date_time is None:
+                continue
+            try:
+                date_time = converter(timestamp)
+            except ValueError:
+                return False
+            if date_time is None:
+                continue
+            if date_time != expected_date_time or (date_time.tzinfo is None) != (expected_date_time.tzinfo is None):
+                return False
+            matched = True
+        return matched
+
+    def __strptime_converter(self, date_format, day_and_month_can_be_swapped):
+        def convert(timestamp):
+            date_time = datetime.strptime(timestamp, date_format)
+            if day_and_month_can_be_swapped and date_time.day <= 12 and date_time.day != date_time.month:
+                return None
+            return self.__in_upload_timezone(date_time)
+
+        return convert
+
+    def __iso_8601_converter(self, timestamp):
+        date_time = parse_iso_8601_timestamp(timestamp)
+        if date_time is None:
+            raise ValueError('"{}" is not an ISO 8601 timestamp'.format(timestamp))
+        return self.__in_upload_timezone(date_time)
+
+    def __in_upload_timezone(self, date_time):
+        # As with dateparser, a timestamp with an offset is converted to the upload's timezone and one without is left
+        # as it is
+        return date_time.astimezone(self.__timezone) if date_time.tzinfo is not None else date_time
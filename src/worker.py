@@ -0,0 +1,110 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+
+from src.event_handler import drain_queue
+from src.sqs import MAX_WAIT_TIME_SECONDS
+
+DEFAULT_WORKER_PROCESSES = 1
+DEFAULT_IDLE_BACKOFF_SECONDS = 1
+DEFAULT_MAX_IDLE_BACKOFF_SECONDS = 60
+
+
+class ShutdownContext:
+    """
+    Stands in for the lambda context while the worker is running. It reports plenty of time remaining until shutdown
+    is requested and none after that, so the drain stops taking new messages in the same way it does when a lambda
+    is close to its deadline.
+    """
+
+    def __init__(self):
+        self.__stopping = threading.Event()
+
+    # noinspection PyUnusedLocal
+    def stop(self, *args):
+        self.__stopping.set()
+
+    def is_stopping(self):
+        return self.__stopping.is_set()
+
+    def wait(self, seconds):
+        """
+        Sleeps for up to the given number of seconds, returning early if shutdown is requested.
+        """
+        return self.__stopping.wait(seconds)
+
+    def get_remaining_time_in_millis(self):
+        return 0 if self.__stopping.is_set() else sys.maxsize
+
+
+def run_worker(context, drain=drain_queue):
+    """
+    Drains the queue over and over until the context is stopped. Once a drain finds the queue empty the worker waits
+    before draining again, doubling the wait each time the queue is still empty up to WORKER_MAX_IDLE_BACKOFF_SECONDS.
+    """
+    logger = logging.getLogger('event-recorder')
+    logger.setLevel(logging.INFO)
+
+    wait_time_seconds = min(int(os.environ.get('WORKER_WAIT_TIME_SECONDS', MAX_WAIT_TIME_SECONDS)),
+                            MAX_WAIT_TIME_SECONDS)
+    idle_backoff_seconds = float(os.environ.get('WORKER_IDLE_BACKOFF_SECONDS', DEFAULT_IDLE_BACKOFF_SECONDS))
+    max_idle_backoff_seconds = float(
+        os.environ.get('WORKER_MAX_IDLE_BACKOFF_SECONDS', DEFAULT_MAX_IDLE_BACKOFF_SECONDS))
+
+    idle_drains = 0
+    while not context.is_stopping():
+        # noinspection PyBroadException
+        try:
+            event_count = drain(context, wait_time_seconds)
+        except Exception:
+            # Back off as if the queue were empty, rather than retrying a failing database or key fetch in a tight loop
+            logger.exception('Failed to drain queue')
+            event_count = 0
+
+        if event_count:
+            idle_drains = 0
+            continue
+
+        context.wait(min(idle_backoff_seconds * 2 ** idle_drains, max_idle_backoff_seconds))
+        idle_drains += 1
+
+    logger.info('Worker stopped')
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s %(process)d %(levelname)s %(name)s %(message)s')
+    worker_processes = int(os.environ.get('WORKER_PROCESSES', DEFAULT_WORKER_PROCESSES))
+    if worker_processes <= 1:
+        __run_worker_process()
+        return
+
+    workers = [multiprocessing.Process(target=__run_worker_process) for _ in range(worker_processes)]
+
+    # noinspection PyUnusedLocal
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    sys.exit(max(abs(worker.exitcode) for worker in workers))
+
+
+def __run_worker_process():
+    context = ShutdownContext()
+    signal.signal(signal.SIGTERM, context.stop)
+    signal.signal(signal.SIGINT, context.stop)
+    run_worker(context)
+
+
+if __name__ == '__main__':
+    main()
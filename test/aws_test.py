@@ -0,0 +1,21 @@
+from unittest import TestCase
+
+from src.aws import get_client, reset_clients
+from test.helpers import setup_stub_aws_config
+
+
+class AwsTest(TestCase):
+
+    def setUp(self):
+        setup_stub_aws_config()
+
+    def test_reuses_client_for_a_service(self):
+        self.assertIs(get_client('s3'), get_client('s3'))
+        self.assertIsNot(get_client('s3'), get_client('kms'))
+
+    def test_creates_new_clients_after_reset(self):
+        s3_client = get_client('s3')
+
+        reset_clients()
+
+        self.assertIsNot(get_client('s3'), s3_client)
@@ -0,0 +1,121 @@
+import logging
+import os
+import threading
+from unittest import TestCase
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from src.common import DatabaseConnectionManager, process_s3_records, db_connection_manager, \
+    record_worker_connection_managers
+from test.helpers import setup_stub_aws_config, DB_PASSWORD
+
+DB_CONNECTION_STRING = "host='event-store' dbname='events' user='postgres' password='{}'".format(DB_PASSWORD)
+
+
+class DatabaseConnectionManagerTest(TestCase):
+
+    def setUp(self):
+        setup_stub_aws_config()
+        os.environ['DB_HEALTH_CHECK_INTERVAL_SECONDS'] = '0'
+        self.logger = logging.getLogger('event-recorder')
+        self.connection_manager = DatabaseConnectionManager()
+
+    def tearDown(self):
+        self.connection_manager.close()
+
+    def test_reuses_a_healthy_connection(self):
+        connection = self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+
+        self.assertIs(self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger), connection)
+
+    def test_reconnects_when_the_connection_has_been_closed(self):
+        connection = self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+        connection.close()
+
+        new_connection = self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+
+        self.assertIsNot(new_connection, connection)
+        self.assertFalse(new_connection.closed)
+
+    def test_rolls_back_a_transaction_left_open_by_an_earlier_invocation(self):
+        connection = self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+        connection.cursor().execute('SELECT 1')
+
+        self.connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+
+        self.assertEqual(connection.get_transaction_status(), TRANSACTION_STATUS_IDLE)
+
+
+class ProcessS3RecordsTest(TestCase):
+
+    def setUp(self):
+        setup_stub_aws_config()
+        self.__close_connections()
+        self.logger = logging.getLogger('event-recorder')
+
+    def tearDown(self):
+        self.__close_connections()
+
+    def test_processes_records_in_turn_on_the_managed_connection(self):
+        processed = []
+
+        process_s3_records(self.__records(3), lambda record, db_connection: processed.append(
+            (record['s3']['object']['key'], db_connection)), DB_CONNECTION_STRING, self.logger)
+
+        managed_connection = db_connection_manager.get_connection(DB_CONNECTION_STRING, self.logger)
+        self.assertEqual(processed, [('key-0', managed_connection), ('key-1', managed_connection),
+                                     ('key-2', managed_connection)])
+
+    def test_processes_records_on_a_managed_connection_per_worker(self):
+        os.environ['RECORD_WORKERS'] = '3'
+        # The first three records wait for each other, so they must be on three workers at once
+        first_records_started = threading.Barrier(3)
+        started = []
+        processed = []
+
+        def process_record(record, db_connection):
+            started.append(record)
+            if len(started) <= 3:
+                first_records_started.wait(timeout=5)
+            processed.append((record['s3']['object']['key'], db_connection, threading.get_ident()))
+
+        process_s3_records(self.__records(6), process_record, DB_CONNECTION_STRING, self.logger)
+
+        self.assertCountEqual([key for key, _, _ in processed], ['key-{}'.format(i) for i in range(6)])
+        connections_by_thread = {}
+        for _, db_connection, thread in processed:
+            self.assertIs(connections_by_thread.setdefault(thread, db_connection), db_connection)
+        connections = set(connections_by_thread.values())
+        self.assertEqual(len(connections), 3)
+        self.assertFalse(any(db_connection.closed for db_connection in connections))
+
+        # A warm invocation uses the same connections
+        del started[:]
+        processed = []
+        process_s3_records(self.__records(6), process_record, DB_CONNECTION_STRING, self.logger)
+
+        self.assertEqual(set(db_connection for _, db_connection, _ in processed), connections)
+
+    def test_processes_the_other_records_when_one_fails_and_then_raises_its_error(self):
+        os.environ['RECORD_WORKERS'] = '2'
+        processed = []
+
+        def process_record(record, db_connection):
+            if record['s3']['object']['key'] == 'key-1':
+                raise ValueError('a bad record')
+            processed.append(record['s3']['object']['key'])
+
+        with self.assertRaises(ValueError):
+            process_s3_records(self.__records(4), process_record, DB_CONNECTION_STRING, self.logger)
+
+        self.assertCountEqual(processed, ['key-0', 'key-2', 'key-3'])
+
+    @staticmethod
+    def __close_connections():
+        db_connection_manager.close()
+        for connection_manager in record_worker_connection_managers:
+            connection_manager.close()
+
+    @staticmethod
+    def __records(count):
+        return [{'s3': {'bucket': {'name': 'a-bucket'}, 'object': {'key': 'key-{}'.format(i)}}} for i in range(count)]
@@ -0,0 +1,100 @@
+from unittest import TestCase
+
+import psycopg2
+from retrying import retry
+from testfixtures import LogCapture
+
+from src.database import RunInTransaction, write_audit_events_to_database, write_audit_event_to_database
+from src.event import Event
+from test.helpers import clean_db, EVENT_TYPE, TIMESTAMP, ORIGINATING_SERVICE, SESSION_EVENT_TYPE
+
+
+def create_event(event_id, session_id, raw_json=None, details_path=()):
+    return Event(
+        event_id=event_id,
+        timestamp=TIMESTAMP,
+        event_type=EVENT_TYPE,
+        originating_service=ORIGINATING_SERVICE,
+        session_id=session_id,
+        details={'session_event_type': SESSION_EVENT_TYPE},
+        raw_json=raw_json,
+        details_path=details_path,
+    )
+
+
+class DatabaseTest(TestCase):
+    db_connection = None
+    db_connection_string = "host='event-store' dbname='events' user='postgres'"
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connect()
+
+    @classmethod
+    @retry(stop_max_attempt_number=5, wait_fixed=500)
+    def connect(cls):
+        cls.db_connection = psycopg2.connect(cls.db_connection_string)
+
+    def tearDown(self):
+        clean_db(self.db_connection)
+
+    def test_writes_batch_of_audit_events_in_one_statement(self):
+        events = [create_event('sample-id-{0}'.format(i), 'session-id-{0}'.format(i)) for i in range(3)]
+
+        stored = write_audit_events_to_database(events, self.db_connection)
+
+        self.assertEqual(stored, [True, True, True])
+        self.assertEqual(self.__stored_event_ids(), ['sample-id-0', 'sample-id-1', 'sample-id-2'])
+
+    def test_reports_duplicate_audit_events_without_aborting_the_batch(self):
+        write_audit_event_to_database(create_event('sample-id-1', 'session-id-1'), self.db_connection)
+        events = [
+            create_event('sample-id-1', 'session-id-1'),
+            create_event('sample-id-2', 'session-id-2'),
+            create_event('sample-id-2', 'session-id-2'),
+        ]
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            stored = write_audit_events_to_database(events, self.db_connection)
+
+            log_capture.check(
+                ('event-recorder', 'WARNING',
+                    'Failed to store an audit event. The Event ID sample-id-1 already exists in the database'),
+                ('event-recorder', 'WARNING',
+                    'Failed to store an audit event. The Event ID sample-id-2 already exists in the database'),
+            )
+
+        self.assertEqual(stored, [False, True, False])
+        self.assertEqual(self.__stored_event_ids(), ['sample-id-1', 'sample-id-2'])
+
+    def test_stores_details_from_the_json_the_event_arrived_as(self):
+        events = [
+            create_event('sample-id-1', 'session-id-1'),
+            create_event('sample-id-2', 'session-id-2', '{"details": {"pid": "é"}, "eventId": "sample-id-2"}',
+                         ('details',)),
+            create_event('sample-id-3', 'session-id-3', '{"document": {"details": {"pid": "3"}}}',
+                         ('document', 'details')),
+        ]
+
+        write_audit_events_to_database(events[:2], self.db_connection)
+        write_audit_event_to_database(events[2], self.db_connection)
+
+        with RunInTransaction(self.db_connection) as cursor:
+            cursor.execute('SELECT event_id, details FROM audit.audit_events ORDER BY event_id;')
+            self.assertEqual(cursor.fetchall(), [
+                ('sample-id-1', {'session_event_type': SESSION_EVENT_TYPE}),
+                ('sample-id-2', {'pid': 'é'}),
+                ('sample-id-3', {'pid': '3'}),
+            ])
+
+    def __stored_event_ids(self):
+        with RunInTransaction(self.db_connection) as cursor:
+            cursor.execute("""
+                SELECT
+                    event_id
+                FROM
+                    audit.audit_events
+                ORDER BY
+                    event_id;
+            """)
+            return [row[0] for row in cursor.fetchall()]
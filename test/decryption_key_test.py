@@ -0,0 +1,77 @@
+from unittest import TestCase
+
+from src.decryption_key import DecryptionKeyCache, DEFAULT_CACHE_TTL_SECONDS, MIN_REFRESH_INTERVAL_SECONDS
+from test.helpers import setup_stub_aws_config
+from test.test_encrypter import encrypt_string
+
+OLD_KEY = b'sixteen byte key'
+NEW_KEY = b'rotated byte key'
+
+
+class StubKeySource(object):
+    def __init__(self, *keys):
+        self.__keys = list(keys)
+        self.fetch_count = 0
+
+    def __call__(self):
+        self.fetch_count += 1
+        return self.__keys.pop(0) if len(self.__keys) > 1 else self.__keys[0]
+
+
+class StubClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class DecryptionKeyCacheTest(TestCase):
+
+    def setUp(self):
+        setup_stub_aws_config()
+        self.clock = StubClock()
+
+    def test_fetches_key_once_while_it_is_fresh(self):
+        key_source = StubKeySource(OLD_KEY)
+        cache = DecryptionKeyCache(key_source, self.clock)
+
+        self.assertEqual(cache.get_key(), OLD_KEY)
+        self.clock.now += DEFAULT_CACHE_TTL_SECONDS - 1
+        self.assertEqual(cache.get_key(), OLD_KEY)
+
+        self.assertEqual(key_source.fetch_count, 1)
+
+    def test_fetches_key_again_once_it_has_expired_or_been_invalidated(self):
+        key_source = StubKeySource(OLD_KEY)
+        cache = DecryptionKeyCache(key_source, self.clock)
+
+        cache.get_key()
+        self.clock.now += DEFAULT_CACHE_TTL_SECONDS
+        cache.get_key()
+        cache.invalidate()
+        cache.get_key()
+
+        self.assertEqual(key_source.fetch_count, 3)
+
+    def test_fetches_key_again_when_a_message_can_not_be_decrypted_with_the_cached_key(self):
+        key_source = StubKeySource(OLD_KEY, NEW_KEY)
+        cache = DecryptionKeyCache(key_source, self.clock)
+        cache.get_key()
+        self.clock.now += MIN_REFRESH_INTERVAL_SECONDS
+
+        decrypted_message = cache.decrypt_message(encrypt_string('{ "rotated": true }', NEW_KEY))
+
+        self.assertEqual(decrypted_message, '{ "rotated": true }')
+        self.assertEqual(cache.get_key(), NEW_KEY)
+        self.assertEqual(key_source.fetch_count, 2)
+
+    def test_does_not_fetch_a_key_which_has_just_been_fetched_again(self):
+        key_source = StubKeySource(OLD_KEY, NEW_KEY)
+        cache = DecryptionKeyCache(key_source, self.clock)
+        cache.get_key()
+
+        with self.assertRaises(Exception):
+            cache.decrypt_message(encrypt_string('{ "rotated": true }', NEW_KEY))
+
+        self.assertEqual(key_source.fetch_count, 1)
@@ -1,4 +1,5 @@
 import base64
+import json
 import os
 import uuid
 from datetime import datetime
@@ -11,15 +12,31 @@ from retrying import retry
 from testfixtures import LogCapture, OutputCapture
 
 from src import event_handler
+from src.common import db_connection_manager
 from src.database import RunInTransaction
+from src.decryption_key import decryption_key_cache
 from test.helpers import setup_stub_aws_config, clean_db, create_event_string, create_fraud_event_string, \
     MINIMUM_LEVEL_OF_ASSURANCE, ENCRYPTION_KEY, create_billing_event_without_minimum_level_of_assurance_string, \
+    create_event_with_null_character_string, \
     create_fraud_event_without_idp_fraud_event_id_string, EVENT_TYPE, TIMESTAMP, ORIGINATING_SERVICE, \
     SESSION_EVENT_TYPE, TRANSACTION_ENTITY_ID, FRAUD_SESSION_EVENT_TYPE, DB_PASSWORD, \
     PID, REQUEST_ID, IDP_ENTITY_ID, PROVIDED_LEVEL_OF_ASSURANCE, PREFERRED_LEVEL_OF_ASSURANCE, GPG45_STATUS
 from test.test_encrypter import encrypt_string
 
 
+class StubContext(object):
+    """
+    A lambda context with plenty of time left for the first few calls, and less than the drain deadline margin after.
+    """
+
+    def __init__(self, calls_before_deadline):
+        self.__calls_before_deadline = calls_before_deadline
+
+    def get_remaining_time_in_millis(self):
+        self.__calls_before_deadline -= 1
+        return 300000 if self.__calls_before_deadline >= 0 else 15000
+
+
 @mock_sqs
 @mock_s3
 @mock_kms
@@ -43,6 +60,8 @@ class EventHandlerTest(TestCase):
 
     def setUp(self):
         setup_stub_aws_config()
+        decryption_key_cache.invalidate()
+        db_connection_manager.close()
         self.__setup_kms()
         self.__setup_db_connection_string()
         self.__setup_sqs()
@@ -97,6 +116,202 @@ class EventHandlerTest(TestCase):
         self.assertEqual(self.__number_of_visible_messages(), '0')
         self.assertEqual(self.__number_of_hidden_messages(), '0')
 
+    def test_drains_more_messages_than_fit_in_a_single_batch(self):
+        self.__setup_s3()
+        expected_events = [('sample-id-{0}'.format(i), 'session-id-{0}'.format(i)) for i in range(25)]
+        self.__encrypt_and_send_to_sqs(
+            [create_event_string(event_id, session_id) for (event_id, session_id) in expected_events]
+        )
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            event_handler.store_queued_events(None, None)
+
+            self.assertIn(
+                ('event-recorder', 'INFO', 'Queue is empty - finishing after 25 events'),
+                log_capture.actual()
+            )
+
+        self.__assert_audit_events_table_has_billing_event_records(expected_events, MINIMUM_LEVEL_OF_ASSURANCE)
+        self.__assert_billing_events_table_has_billing_event_records(
+            [(session_id, event_id) for (event_id, session_id) in expected_events])
+        self.assertEqual(self.__number_of_visible_messages(), '0')
+        self.assertEqual(self.__number_of_hidden_messages(), '0')
+
+    def test_releases_the_messages_in_hand_when_close_to_the_deadline(self):
+        self.__setup_s3()
+        self.__encrypt_and_send_to_sqs(
+            [create_event_string('sample-id-{0}'.format(i), 'session-id-{0}'.format(i)) for i in range(25)]
+        )
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            event_count = event_handler.drain_queue(StubContext(calls_before_deadline=3))
+
+            deadline_logs = [message for (_, level, message) in log_capture.actual()
+                             if message.startswith('Close to the lambda deadline')]
+            self.assertEqual(len(deadline_logs), 1)
+
+        self.assertLess(event_count, 25)
+        # The messages which were received but not stored are visible again straight away, rather than when their
+        # visibility timeout ends
+        self.assertEqual(self.__number_of_visible_messages(), str(25 - event_count))
+        self.assertEqual(self.__number_of_hidden_messages(), '0')
+
+    def test_stores_events_in_groups_when_group_commit_is_enabled(self):
+        self.__setup_s3()
+        os.environ['GROUP_COMMIT_SIZE'] = '3'
+        event_id_3 = str(uuid.uuid4())
+        self.__encrypt_and_send_to_sqs(
+            [
+                create_event_string('sample-id-1', 'session-id-1'),
+                create_event_string('sample-id-2', 'session-id-2'),
+                create_fraud_event_string(event_id_3, 'session-id-3', 'fraud-event-id-1'),
+                create_event_string('sample-id-4', 'session-id-4'),
+            ]
+        )
+
+        event_handler.store_queued_events(None, None)
+
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-2', 'session-id-2'), ('sample-id-4', 'session-id-4')],
+            MINIMUM_LEVEL_OF_ASSURANCE)
+        self.__assert_audit_events_table_has_fraud_event_records([(event_id_3, 'session-id-3', 'fraud-event-id-1')])
+        self.__assert_billing_events_table_has_billing_event_records(
+            [('session-id-1', 'sample-id-1'), ('session-id-2', 'sample-id-2'), ('session-id-4', 'sample-id-4')])
+        self.__assert_fraud_events_table_has_fraud_event_records([(event_id_3, 'session-id-3', 'fraud-event-id-1')])
+        self.assertEqual(self.__number_of_visible_messages(), '0')
+        self.assertEqual(self.__number_of_hidden_messages(), '0')
+
+    def test_group_commit_falls_back_to_storing_each_event_on_its_own(self):
+        self.__setup_s3()
+        os.environ['GROUP_COMMIT_SIZE'] = '10'
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            message_ids = self.__encrypt_and_send_to_sqs(
+                [
+                    create_event_string('sample-id-1', 'session-id-1'),
+                    create_event_with_null_character_string('sample-id-2', 'session-id-2'),
+                    create_event_string('sample-id-3', 'session-id-3'),
+                ]
+            )
+
+            event_handler.store_queued_events(None, None)
+
+            self.assertIn(
+                ('event-recorder', 'WARNING', 'Failed to store a group of 3 events - retrying each event on its own'),
+                log_capture.actual()
+            )
+            self.assertIn(
+                ('event-recorder', 'ERROR',
+                    'Failed to store event {0}, event type "{1}" from SQS message ID {2}'.format(
+                        'sample-id-2', EVENT_TYPE, message_ids[1])),
+                log_capture.actual()
+            )
+
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-3', 'session-id-3')], MINIMUM_LEVEL_OF_ASSURANCE)
+        self.__assert_audit_events_table_does_not_have_event('sample-id-2')
+        self.__assert_billing_events_table_has_billing_event_records(
+            [('session-id-1', 'sample-id-1'), ('session-id-3', 'sample-id-3')])
+        self.assertEqual(self.__number_of_visible_messages(), '0')
+        self.assertEqual(self.__number_of_hidden_messages(), '1')
+
+    def test_group_commit_rejects_an_incomplete_event_before_storing_the_rest_of_the_group(self):
+        self.__setup_s3()
+        os.environ['GROUP_COMMIT_SIZE'] = '10'
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            message_ids = self.__encrypt_and_send_to_sqs(
+                [
+                    create_event_string('sample-id-1', 'session-id-1'),
+                    create_billing_event_without_minimum_level_of_assurance_string('sample-id-2', 'session-id-2'),
+                    create_event_string('sample-id-3', 'session-id-3'),
+                ]
+            )
+
+            event_handler.store_queued_events(None, None)
+
+            self.assertIn(
+                ('event-recorder', 'ERROR',
+                    'Invalid event from SQS message ID {0}: Invalid Message. Missing required billing details field '
+                    '"minimum_level_of_assurance"'.format(message_ids[1])),
+                log_capture.actual()
+            )
+            self.assertIn(
+                ('event-recorder', 'INFO', 'Stored 2 events in a single transaction'),
+                log_capture.actual()
+            )
+
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-3', 'session-id-3')], MINIMUM_LEVEL_OF_ASSURANCE)
+        self.__assert_audit_events_table_does_not_have_event('sample-id-2')
+        self.__assert_billing_events_table_has_billing_event_records(
+            [('session-id-1', 'sample-id-1'), ('session-id-3', 'sample-id-3')])
+        self.assertEqual(self.__number_of_visible_messages(), '0')
+        self.assertEqual(self.__number_of_hidden_messages(), '1')
+
+    def test_decodes_messages_on_worker_pool_and_logs_them_in_order(self):
+        self.__setup_s3()
+        os.environ['DECODE_WORKERS'] = '4'
+        os.environ['DECODE_QUEUE_SIZE'] = '3'
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            message_ids = self.__encrypt_and_send_to_sqs(
+                [
+                    create_event_string('sample-id-1', 'session-id-1'),
+                    'invalid event',
+                    create_event_string('sample-id-3', 'session-id-3'),
+                ]
+            )
+
+            event_handler.store_queued_events(None, None)
+
+            log_capture.check(
+                ('event-recorder', 'INFO', 'Got decryption key from S3'),
+                ('event-recorder', 'INFO', 'Decrypted key successfully'),
+                ('event-recorder', 'INFO', 'Created connection to DB'),
+                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
+                ('event-recorder', 'INFO', 'Stored audit event: sample-id-1'),
+                ('event-recorder', 'INFO', 'Stored billing event: sample-id-1'),
+                ('event-recorder', 'ERROR', 'Failed to decrypt message, SQS ID = {0}'.format(message_ids[1])),
+                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-3'),
+                ('event-recorder', 'INFO', 'Stored audit event: sample-id-3'),
+                ('event-recorder', 'INFO', 'Stored billing event: sample-id-3'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: sample-id-1'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: sample-id-3'),
+                ('event-recorder', 'INFO', 'Queue is empty - finishing after 3 events')
+            )
+
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-3', 'session-id-3')], MINIMUM_LEVEL_OF_ASSURANCE)
+        self.assertEqual(self.__number_of_visible_messages(), '0')
+        self.assertEqual(self.__number_of_hidden_messages(), '1')
+
+    def test_stores_events_from_sqs_trigger_and_reports_failed_messages(self):
+        self.__setup_s3()
+        records = [
+            self.__sqs_record('message-id-1', create_event_string('sample-id-1', 'session-id-1')),
+            self.__sqs_record('message-id-2', 'invalid event'),
+            self.__sqs_record('message-id-3', create_event_string('sample-id-3', 'session-id-3')),
+        ]
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            response = event_handler.store_sqs_events({'Records': records}, None)
+
+            log_capture.check(
+                ('event-recorder', 'INFO', 'Got decryption key from S3'),
+                ('event-recorder', 'INFO', 'Decrypted key successfully'),
+                ('event-recorder', 'INFO', 'Created connection to DB'),
+                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
+                ('event-recorder', 'INFO', 'Stored audit event: sample-id-1'),
+                ('event-recorder', 'INFO', 'Stored billing event: sample-id-1'),
+                ('event-recorder', 'ERROR', 'Failed to decrypt message, SQS ID = message-id-2'),
+                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-3'),
+                ('event-recorder', 'INFO', 'Stored audit event: sample-id-3'),
+                ('event-recorder', 'INFO', 'Stored billing event: sample-id-3'),
+                ('event-recorder', 'INFO', 'Stored 2 of 3 events from SQS'),
+            )
+
+        self.assertEqual(response, {'batchItemFailures': [{'itemIdentifier': 'message-id-2'}]})
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-3', 'session-id-3')], MINIMUM_LEVEL_OF_ASSURANCE)
+
     def test_reads_messages_from_queue_with_key_from_env(self):
         os.environ['ENCRYPTION_KEY'] = self.__encrypt(ENCRYPTION_KEY)
         self.__encrypt_and_send_to_sqs(
@@ -133,7 +348,7 @@ class EventHandlerTest(TestCase):
         self.__assert_billing_events_table_has_billing_event_records(
             [('session-id-1', 'sample-id-1'), ('session-id-2', 'sample-id-2')])
 
-    def test_writes_incomplete_billing_event_to_audit_events_table_but_not_to_billing_events_table(self):
+    def test_rejects_incomplete_billing_event_without_writing_it_to_the_database(self):
         self.__setup_s3()
         with LogCapture('event-recorder', propagate=False) as log_capture:
             message_ids = self.__encrypt_and_send_to_sqs(
@@ -144,26 +359,22 @@ class EventHandlerTest(TestCase):
 
             event_handler.store_queued_events(None, None)
 
-            self.__assert_audit_events_table_has_billing_event_records([('sample-id-1', 'session-id-1')], None)
-            self.__assert_billing_events_table_has_no_billing_event_records
-            self.__assert_fraud_events_table_has_no_fraud_event_records
+            self.__assert_audit_events_table_does_not_have_event('sample-id-1')
+            self.__assert_billing_events_table_has_no_billing_event_records()
+            self.__assert_fraud_events_table_has_no_fraud_event_records()
             log_capture.check(
                 ('event-recorder', 'INFO', 'Got decryption key from S3'),
                 ('event-recorder', 'INFO', 'Decrypted key successfully'),
                 ('event-recorder', 'INFO', 'Created connection to DB'),
-                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
-                ('event-recorder', 'INFO', 'Stored audit event: sample-id-1'),
-                ('event-recorder', 'WARNING',
-                    'Failed to store a billing event [Event ID sample-id-1] due to key error'),
                 ('event-recorder', 'ERROR',
-                    'Failed to store event {0}, event type "{1}" from SQS message ID {2}'.format(
-                        'sample-id-1', EVENT_TYPE, message_ids[0])),
+                    'Invalid event from SQS message ID {0}: Invalid Message. Missing required billing details field '
+                    '"minimum_level_of_assurance"'.format(message_ids[0])),
                 ('event-recorder', 'INFO', 'Queue is empty - finishing after 1 events')
             )
             self.assertEqual(self.__number_of_visible_messages(), '0')
             self.assertEqual(self.__number_of_hidden_messages(), '1')
 
-    def test_writes_incomplete_fraud_event_to_audit_events_table_but_not_to_fraud_events_table(self):
+    def test_rejects_incomplete_fraud_event_without_writing_it_to_the_database(self):
         self.__setup_s3()
         with LogCapture('event-recorder', propagate=False) as log_capture:
             message_ids = self.__encrypt_and_send_to_sqs(
@@ -174,19 +385,16 @@ class EventHandlerTest(TestCase):
 
             event_handler.store_queued_events(None, None)
 
-            self.__assert_audit_events_table_has_fraud_event_records([('sample-id-1', 'session-id-1', None)])
-            self.__assert_billing_events_table_has_no_billing_event_records
-            self.__assert_fraud_events_table_has_no_fraud_event_records
+            self.__assert_audit_events_table_does_not_have_event('sample-id-1')
+            self.__assert_billing_events_table_has_no_billing_event_records()
+            self.__assert_fraud_events_table_has_no_fraud_event_records()
             log_capture.check(
                 ('event-recorder', 'INFO', 'Got decryption key from S3'),
                 ('event-recorder', 'INFO', 'Decrypted key successfully'),
                 ('event-recorder', 'INFO', 'Created connection to DB'),
-                ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
-                ('event-recorder', 'INFO', 'Stored audit event: sample-id-1'),
-                ('event-recorder', 'WARNING', 'Failed to store a fraud event [Event ID sample-id-1] due to key error'),
                 ('event-recorder', 'ERROR',
-                    'Failed to store event {0}, event type "{1}" from SQS message ID {2}'.format(
-                        'sample-id-1', EVENT_TYPE, message_ids[0])),
+                    'Invalid event from SQS message ID {0}: Invalid Message. Missing required fraud details field '
+                    '"idp_fraud_event_id"'.format(message_ids[0])),
                 ('event-recorder', 'INFO', 'Queue is empty - finishing after 1 events')
             )
             self.assertEqual(self.__number_of_visible_messages(), '0')
@@ -222,6 +430,38 @@ class EventHandlerTest(TestCase):
             self.assertEqual(self.__number_of_visible_messages(), '0')
             self.assertEqual(self.__number_of_hidden_messages(), '1')
 
+    def test_stores_and_deletes_an_event_with_null_details(self):
+        self.__setup_s3()
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            self.__encrypt_and_send_to_sqs(
+                [
+                    json.dumps({
+                        'eventId': 'error-id-1',
+                        'eventType': 'error_event',
+                        'timestamp': TIMESTAMP,
+                        'originatingService': ORIGINATING_SERVICE,
+                        'sessionId': 'session-id-1',
+                        'details': None,
+                    }),
+                ]
+            )
+
+            event_handler.store_queued_events(None, None)
+
+            log_capture.check(
+                ('event-recorder', 'INFO', 'Got decryption key from S3'),
+                ('event-recorder', 'INFO', 'Decrypted key successfully'),
+                ('event-recorder', 'INFO', 'Created connection to DB'),
+                ('event-recorder', 'INFO', 'Decrypted event with ID: error-id-1'),
+                ('event-recorder', 'INFO', 'Stored audit event: error-id-1'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: error-id-1'),
+                ('event-recorder', 'INFO', 'Queue is empty - finishing after 1 events')
+            )
+            self.__assert_billing_events_table_has_no_billing_event_records()
+            self.__assert_fraud_events_table_has_no_fraud_event_records()
+            self.assertEqual(self.__number_of_visible_messages(), '0')
+            self.assertEqual(self.__number_of_hidden_messages(), '0')
+
     def test_event_handler_logs_event_to_stdout(self):
         self.__setup_s3()
         with OutputCapture() as output:
@@ -259,7 +499,6 @@ class EventHandlerTest(TestCase):
                 ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
                 ('event-recorder', 'INFO', 'Stored audit event: sample-id-1'),
                 ('event-recorder', 'INFO', 'Stored billing event: sample-id-1'),
-                ('event-recorder', 'INFO', 'Deleted event from queue with ID: sample-id-1'),
                 ('event-recorder', 'INFO', 'Decrypted event with ID: sample-id-1'),
                 ('event-recorder', 'WARNING',
                     'Failed to store an audit event. The Event ID sample-id-1 already exists in the database'),
@@ -268,6 +507,7 @@ class EventHandlerTest(TestCase):
                     'Failed to store a billing event. The Event ID sample-id-1 already exists in the database'),
                 ('event-recorder', 'INFO', 'Stored billing event: sample-id-1'),
                 ('event-recorder', 'INFO', 'Deleted event from queue with ID: sample-id-1'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: sample-id-1'),
                 ('event-recorder', 'INFO', 'Queue is empty - finishing after 2 events')
             )
             self.assertEqual(self.__number_of_visible_messages(), '0')
@@ -285,6 +525,15 @@ class EventHandlerTest(TestCase):
             message_ids.append(response['MessageId'])
         return message_ids
 
+    @staticmethod
+    def __sqs_record(message_id, message):
+        return {
+            'messageId': message_id,
+            'receiptHandle': 'receipt-handle-{0}'.format(message_id),
+            'body': encrypt_string(message, ENCRYPTION_KEY),
+            'eventSource': 'aws:sqs',
+        }
+
     def __number_of_visible_messages(self):
         return self.__get_attribute('ApproximateNumberOfMessages')
 
@@ -374,6 +623,20 @@ class EventHandlerTest(TestCase):
             self.assertEqual(matching_records[9], event[2])
             self.assertEqual(matching_records[10], GPG45_STATUS)
 
+    def __assert_audit_events_table_does_not_have_event(self, event_id):
+        with RunInTransaction(self.db_connection) as cursor:
+            cursor.execute("""
+                SELECT
+                    *
+                FROM
+                    audit.audit_events
+                WHERE
+                    event_id = %s;
+            """, [event_id])
+            matching_records = cursor.fetchone()
+
+        self.assertIsNone(matching_records)
+
     def __assert_billing_events_table_has_no_billing_event_records(self):
         with RunInTransaction(self.db_connection) as cursor:
             cursor.execute("""
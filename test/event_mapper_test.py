@@ -1,4 +1,5 @@
 import json
+from datetime import datetime
 from json import JSONDecodeError
 from unittest import TestCase
 
@@ -101,6 +102,52 @@ class EventTest(TestCase):
                 'Invalid Message. Missing required field "{0}"'.format(element)
             )
 
+    def test_throws_validation_exception_if_details_are_missing_a_field_a_derived_table_needs(self):
+        message_object = valid_message_object()
+        message_object['details'] = {
+            'session_event_type': 'idp_authn_succeeded',
+            'pid': 'a pid',
+            'request_id': 'a request id',
+            'idp_entity_id': 'an idp',
+            'provided_level_of_assurance': 'LEVEL_2',
+            'transaction_entity_id': 'a transaction',
+        }
+
+        with self.assertRaises(ValueError) as raised_exception:
+            event_from_json(json.dumps(message_object))
+
+        self.assertEqual(
+            str(raised_exception.exception),
+            'Invalid Message. Missing required billing details field "minimum_level_of_assurance"'
+        )
+
+    def test_keeps_the_json_the_event_was_read_from(self):
+        json_string = json.dumps(valid_message_object())
+
+        event = event_from_json(json_string)
+
+        self.assertEqual(event.raw_json, json_string)
+        self.assertEqual(event.details_path, ('details',))
+
+    def test_parses_iso_8601_timestamps_in_the_shapes_services_send(self):
+        timestamps = {
+            '2018-02-10T12:00:00Z': TIMESTAMP,
+            '2018-02-10T13:30:00+01:30': TIMESTAMP,
+            '2018-02-10T07:00:00.250-0500': TIMESTAMP + 250,
+            '2018-02-10 12:00:00.1239999Z': TIMESTAMP + 123,
+            '2018-02-10T12:00:00': int(datetime(2018, 2, 10, 12).timestamp() * 1000),
+        }
+
+        for timestamp, expected in timestamps.items():
+            event = event_from_json(json.dumps(message_object_with_timestamp(timestamp)))
+
+            self.assertEqual(event.timestamp, expected, timestamp)
+
+    def test_falls_back_to_dateutil_for_other_timestamp_formats(self):
+        event = event_from_json(json.dumps(message_object_with_timestamp('10 February 2018 12:00:00 UTC')))
+
+        self.assertEqual(event.timestamp, TIMESTAMP)
+
     def test_throws_validation_exception_if_string_is_not_valid_json(self):
         with self.assertRaises(JSONDecodeError):
             event_from_json('not valid')
@@ -132,6 +179,12 @@ def import_message_object():
     }
 
 
+def message_object_with_timestamp(timestamp):
+    message_object = import_message_object()
+    message_object['timestamp'] = timestamp
+    return message_object
+
+
 def valid_error_message_object_without_session_id():
     return {
         'eventId': EVENT_ID,
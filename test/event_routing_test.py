@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+from src.event import Event, InvalidEventError
+from src.event_routing import routes_for, group_by_route, write_routed_events, validate_details, BILLING_ROUTE, \
+    FRAUD_ROUTE, EVENT_ROUTES, EventRoute
+
+
+class EventRoutingTest(TestCase):
+
+    def test_routes_events_by_event_type_and_session_event_type(self):
+        self.assertEqual(routes_for(self.__event('1', 'session_event', 'idp_authn_succeeded')), (BILLING_ROUTE,))
+        self.assertEqual(routes_for(self.__event('2', 'session_event', 'fraud_detected')), (FRAUD_ROUTE,))
+        self.assertEqual(routes_for(self.__event('3', 'session_event', 'session_started')), ())
+        self.assertEqual(routes_for(self.__event('4', 'error_event', 'idp_authn_succeeded')), ())
+        self.assertEqual(routes_for(self.__event('5', 'session_event', None)), ())
+
+    def test_does_not_route_events_whose_details_are_not_an_object(self):
+        for details in [None, 'some details', ['some', 'details']]:
+            event = Event('1', 1518264000000, 'error_event', 'a service', 'session-id', details)
+
+            self.assertEqual(routes_for(event), ())
+            self.assertEqual(group_by_route([event]), {})
+            validate_details('error_event', details)
+
+    def test_groups_events_by_route_in_order(self):
+        billing_1 = self.__event('1', 'session_event', 'idp_authn_succeeded')
+        fraud = self.__event('2', 'session_event', 'fraud_detected')
+        other = self.__event('3', 'session_event', 'session_started')
+        billing_2 = self.__event('4', 'session_event', 'idp_authn_succeeded')
+
+        events_by_route = group_by_route([billing_1, fraud, other, billing_2])
+
+        self.assertEqual(list(events_by_route.items()), [
+            (BILLING_ROUTE, [billing_1, billing_2]),
+            (FRAUD_ROUTE, [fraud]),
+        ])
+
+    def test_writes_each_route_with_a_single_call(self):
+        written = []
+        route = EventRoute('test', None, lambda events, cursor: written.append((events, cursor)), None, None)
+        original_routes = dict(EVENT_ROUTES)
+        EVENT_ROUTES[('test_event', 'tested')] = (route,)
+        try:
+            events = [self.__event('1', 'test_event', 'tested'), self.__event('2', 'test_event', 'tested')]
+            write_routed_events(events, 'a cursor')
+        finally:
+            EVENT_ROUTES.clear()
+            EVENT_ROUTES.update(original_routes)
+
+        self.assertEqual(written, [(events, 'a cursor')])
+
+    def test_validates_details_against_each_route_the_event_is_written_to(self):
+        fraud_details = {
+            'session_event_type': 'fraud_detected',
+            'pid': 'a pid',
+            'request_id': 'a request id',
+            'idp_entity_id': 'an idp',
+            'gpg45_status': 'AA01',
+            'transaction_entity_id': 'a transaction',
+        }
+
+        with self.assertRaises(InvalidEventError) as raised_exception:
+            validate_details('session_event', fraud_details)
+
+        self.assertEqual(str(raised_exception.exception),
+                         'Invalid Message. Missing required fraud details field "idp_fraud_event_id"')
+        validate_details('session_event', dict(fraud_details, idp_fraud_event_id='a fraud event id'))
+        validate_details('error_event', fraud_details)
+        validate_details('session_event', {'session_event_type': 'session_started'})
+
+    @staticmethod
+    def __event(event_id, event_type, session_event_type):
+        details = {} if session_event_type is None else {'session_event_type': session_event_type}
+        return Event(event_id, 1518264000000, event_type, 'a service', 'session-id', details)
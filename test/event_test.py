@@ -0,0 +1,38 @@
+from unittest import TestCase
+
+from src.event import Event
+
+
+class EventTest(TestCase):
+
+    def test_is_immutable_and_has_no_instance_dictionary(self):
+        event = Event('event-id', 1518264000000, 'session_event', 'a service', 'session-id', {'pid': 'a pid'})
+
+        with self.assertRaises(AttributeError):
+            event.event_id = 'another-id'
+        self.assertFalse(hasattr(event, '__dict__'))
+
+    def test_builds_the_same_event_from_a_parsed_message(self):
+        json_object = {
+            'eventId': 'event-id',
+            'eventType': 'session_event',
+            'timestamp': '2018-02-10T12:00:00Z',
+            'originatingService': 'a service',
+            'sessionId': 'session-id',
+            'details': {'pid': 'a pid'},
+        }
+
+        event = Event.from_json_object(json_object, 1518264000000, '{"raw": true}', ('details',))
+
+        self.assertEqual(event, Event(
+            event_id='event-id',
+            timestamp=1518264000000,
+            event_type='session_event',
+            originating_service='a service',
+            session_id='session-id',
+            details={'pid': 'a pid'},
+            raw_json='{"raw": true}',
+            details_path=('details',),
+        ))
+        self.assertIsNone(Event(*event[:6]).raw_json)
+        self.assertEqual(Event(*event[:6]).details_path, ())
@@ -2,6 +2,7 @@ import json
 import os
 import boto3
 import botocore.exceptions
+from src.aws import reset_clients
 from src.database import RunInTransaction
 
 EVENT_TYPE = 'session_event'
@@ -31,6 +32,7 @@ def clean_db(db_connection):
             DELETE FROM billing.fraud_events;
             DELETE FROM billing.billing_events;
             DELETE FROM audit.audit_events;
+            DELETE FROM audit.import_checkpoints;
         """)
 
 
@@ -40,6 +42,8 @@ def setup_stub_aws_config():
         'AWS_ACCESS_KEY_ID': 'AWS_ACCESS_KEY_ID',
         'AWS_SECRET_ACCESS_KEY': 'AWS_SECRET_ACCESS_KEY'
     }
+    # Clients are cached between invocations, so make sure each test creates them against its own mocks
+    reset_clients()
 
 
 def create_event_string(event_id, session_id):
@@ -62,6 +66,16 @@ def create_event_string(event_id, session_id):
     })
 
 
+def create_event_with_null_character_string(event_id, session_id):
+    """
+    A billing event which maps fine, but which the database refuses, as jsonb can't hold the \\u0000 escape in its
+    details.
+    """
+    event = json.loads(create_event_string(event_id, session_id))
+    event['details']['note'] = 'a\x00b'
+    return json.dumps(event)
+
+
 def create_billing_event_without_minimum_level_of_assurance_string(event_id, session_id):
     return json.dumps({
         'eventId': event_id,
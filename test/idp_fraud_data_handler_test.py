@@ -12,6 +12,7 @@ from retrying import retry
 from testfixtures import LogCapture
 
 from src import idp_fraud_data_handler, database, event_mapper
+from src.common import db_connection_manager
 from src.database import RunInTransaction
 from src.idp_fraud_event import IdpFraudEvent
 from test.helpers import IDP_ENTITY_ID, clean_db, file_exists_in_s3, setup_stub_aws_config, \
@@ -43,6 +44,7 @@ class IdpFraudDataHandlerTest(TestCase):
 
     def setUp(self):
         setup_stub_aws_config()
+        db_connection_manager.close()
         self.__setup_s3()
         self.__setup_db_connection_string()
 
@@ -210,34 +212,6 @@ class IdpFraudDataHandlerTest(TestCase):
                     'INFO',
                     'Processing data for IDP {}'.format(IDP_ENTITY_ID)
                 ),
-                (
-                    'idp_fraud_data_handler',
-                    'INFO',
-                    'Successfully wrote IDP fraud event ID {} to database.'.format(
-                        idp_fraud_events[0].idp_event_id
-                    )
-                ),
-                (
-                    'idp_fraud_data_handler',
-                    'INFO',
-                    'Successfully wrote IDP fraud event ID {} to database.'.format(
-                        idp_fraud_events[1].idp_event_id
-                    )
-                ),
-                (
-                    'idp_fraud_data_handler',
-                    'INFO',
-                    'Successfully wrote IDP fraud event ID {} to database.'.format(
-                        idp_fraud_events[2].idp_event_id
-                    )
-                ),
-                (
-                    'idp_fraud_data_handler',
-                    'INFO',
-                    'Successfully wrote IDP fraud event ID {} to database.'.format(
-                        idp_fraud_events[3].idp_event_id
-                    )
-                ),
                 (
                     'idp_fraud_data_handler',
                     'ERROR',
@@ -258,6 +232,98 @@ class IdpFraudDataHandlerTest(TestCase):
             )
             self.__assert_upload_file_has_been_moved_to_folder(idp_fraud_data_handler.ERROR_FOLDER)
 
+    def test_row_which_fails_in_the_database_is_reported_with_its_own_line_number(self):
+        idp_fraud_events = self.__generate_test_idp_fraud_events()
+        self.__write_import_file_to_s3(idp_fraud_events, error_rows=[
+            '2019-01-20T18:30:15.1110000Z,5555555,DF01,,not-a-score,_req5555555,111.111.111.111,pid5555555',
+            '2019-01-20T18:31:15.1110000Z,6666666,DF01,,-5,_req6666666,111.111.111.111,pid6666666',
+        ])
+
+        with LogCapture('idp_fraud_data_handler', propagate=False) as log_capture:
+            idp_fraud_data_handler.idp_fraud_data_events(self.__create_s3_event(), None)
+
+            errors = [message for (_, level, message) in log_capture.actual() if level == 'ERROR']
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(errors[0].endswith('(line 6)'))
+            self.assertIn(('idp_fraud_data_handler', 'WARNING', 'Processing Failed'), log_capture.actual())
+
+        self.__assert_upload_session_exists_in_database(False)
+        self.__assert_no_events_exist_in_database(idp_fraud_events)
+        self.__assert_errors_in_database_failure_table([
+            (6, '**Row Exception**'),
+        ])
+        self.__assert_upload_file_has_been_moved_to_folder(idp_fraud_data_handler.ERROR_FOLDER)
+
+    def test_reject_all_policy_records_every_invalid_row_and_stores_nothing(self):
+        idp_fraud_events = self.__generate_test_idp_fraud_events()
+        self.__write_import_file_to_s3(idp_fraud_events, error_rows=[
+            '"01/01/2019 11:00",,,',
+            '2019-01-20T18:30:15.1110000Z,5555555,DF01,,not-a-score,_req5555555,111.111.111.111,pid5555555',
+            '"01/01/2019 12:00",,,',
+        ], extra_tags={'error_policy': idp_fraud_data_handler.ERROR_POLICY_REJECT_ALL})
+
+        with LogCapture('idp_fraud_data_handler', propagate=False) as log_capture:
+            idp_fraud_data_handler.idp_fraud_data_events(self.__create_s3_event(), None)
+
+            self.assertIn(('idp_fraud_data_handler', 'WARNING', 'Processing Failed'), log_capture.actual())
+
+        self.__assert_upload_session_exists_in_database(False)
+        self.__assert_no_events_exist_in_database(idp_fraud_events)
+        self.__assert_errors_in_database_failure_table([
+            (6, '**Row Exception**'),
+            (7, '**Row Exception**'),
+            (8, '**Row Exception**'),
+        ])
+        self.__assert_upload_file_has_been_moved_to_folder(idp_fraud_data_handler.ERROR_FOLDER)
+
+    def test_accept_valid_policy_records_every_invalid_row_and_stores_the_valid_ones(self):
+        idp_fraud_events = self.__generate_test_idp_fraud_events()
+        self.__write_import_file_to_s3(idp_fraud_events, error_rows=[
+            '"01/01/2019 11:00",,,',
+            '2019-01-20T18:30:15.1110000Z,5555555,DF01,,not-a-score,_req5555555,111.111.111.111,pid5555555',
+        ], extra_tags={'error_policy': idp_fraud_data_handler.ERROR_POLICY_ACCEPT_VALID})
+
+        with LogCapture('idp_fraud_data_handler', propagate=False) as log_capture:
+            idp_fraud_data_handler.idp_fraud_data_events(self.__create_s3_event(), None)
+
+            self.assertIn(('idp_fraud_data_handler', 'INFO', 'Processing successful'), log_capture.actual())
+
+        self.__assert_upload_session_exists_in_database(True)
+        self.__assert_events_exist_in_database(idp_fraud_events)
+        self.__assert_errors_in_database_failure_table([
+            (6, '**Row Exception**'),
+            (7, '**Row Exception**'),
+        ])
+        self.__assert_upload_file_has_been_moved_to_folder(idp_fraud_data_handler.SUCCESS_FOLDER)
+
+    @parameterized.expand([
+        (idp_fraud_data_handler.ERROR_POLICY_REJECT_ALL,),
+        (idp_fraud_data_handler.ERROR_POLICY_ACCEPT_VALID,),
+    ])
+    def test_file_which_cannot_be_read_is_recorded_as_a_file_error_and_stores_nothing(self, error_policy):
+        idp_fraud_events = self.__generate_test_idp_fraud_events()
+        rows = ['Event Time,Event ID,FID code,Contra Indicators,Contra Score, Request ID, Client IP Address, PID']
+        rows.extend([self.__idp_fraud_event_to_csv_string(event, ',') for event in idp_fraud_events])
+        # A byte which isn't valid UTF-8 stops the file from being decoded
+        content = '\n'.join(rows).encode('utf-8') + b'\n2019-01-20T18:30:15.1110000Z,5555555,DF01,,\xff'
+        self.__write_to_s3(UPLOAD_BUCKET_NAME, UPLOAD_FILE_NAME, content, {'error_policy': error_policy})
+
+        with LogCapture('idp_fraud_data_handler', propagate=False) as log_capture:
+            idp_fraud_data_handler.idp_fraud_data_events(self.__create_s3_event(), None)
+
+            errors = [message for (_, level, message) in log_capture.actual() if level == 'ERROR']
+            self.assertEqual(len(errors), 1)
+            self.assertTrue(errors[0].startswith(
+                "Failed to read the upload file: 'utf-8' codec can't decode byte 0xff"))
+            self.assertIn(('idp_fraud_data_handler', 'WARNING', 'Processing Failed'), log_capture.actual())
+
+        self.__assert_upload_session_exists_in_database(False)
+        self.__assert_no_events_exist_in_database(idp_fraud_events)
+        self.__assert_errors_in_database_failure_table([
+            (0, '**File Exception**'),
+        ])
+        self.__assert_upload_file_has_been_moved_to_folder(idp_fraud_data_handler.ERROR_FOLDER)
+
     def test_handles_dates_in_different_formats_and_dst(self):
         idp_fraud_events = self.__generate_test_idp_fraud_events([
             IdpFraudEvent(
@@ -394,6 +460,17 @@ class IdpFraudDataHandlerTest(TestCase):
             self.assertEqual(result[3], field)
             self.assertEqual(result[4], message)
 
+    def __assert_errors_in_database_failure_table(self, expected_errors):
+        with RunInTransaction(self.db_connection) as cursor:
+            cursor.execute("""
+                SELECT
+                    row,
+                    field
+                  FROM idp_data.upload_session_validation_failures
+                 ORDER BY row ASC
+            """)
+            self.assertEqual([tuple(result) for result in cursor.fetchall()], expected_errors)
+
     def __assert_events_exist_in_database(self, idp_fraud_events):
         with RunInTransaction(self.db_connection) as cursor:
             for event in idp_fraud_events:
@@ -485,19 +562,20 @@ class IdpFraudDataHandlerTest(TestCase):
             Bucket=UPLOAD_BUCKET_NAME,
         )
 
-    def __write_import_file_to_s3(self, idp_fraud_events, contra_delimiter=',', error_rows=[]):
+    def __write_import_file_to_s3(self, idp_fraud_events, contra_delimiter=',', error_rows=[], extra_tags={}):
         rows = [
             'Event Time,Event ID,FID code,Contra Indicators,Contra Score, Request ID, Client IP Address, PID'
         ]
         rows.extend([self.__idp_fraud_event_to_csv_string(event, contra_delimiter) for event in idp_fraud_events])
         rows.extend(error_rows)
-        self.__write_to_s3(UPLOAD_BUCKET_NAME, UPLOAD_FILE_NAME, '\n'.join(rows))
+        self.__write_to_s3(UPLOAD_BUCKET_NAME, UPLOAD_FILE_NAME, '\n'.join(rows), extra_tags)
 
-    def __write_to_s3(self, bucket_name, filename, content):
+    def __write_to_s3(self, bucket_name, filename, content, extra_tags={}):
         tags = {
             'username': UPLOAD_USERNAME,
             'idp': IDP_ENTITY_ID,
         }
+        tags.update(extra_tags)
         self.__s3_client.put_object(
             Bucket=bucket_name,
             Key=filename,
@@ -11,7 +11,10 @@ from testfixtures import LogCapture
 from retrying import retry
 
 from src import import_handler
-from src.database import RunInTransaction
+from src.aws import reset_clients
+from src.common import db_connection_manager
+from src.database import RunInTransaction, read_import_checkpoint, write_import_checkpoint
+from src.import_checkpoint import ImportCheckpoint
 
 EVENT_TYPE = 'session_event'
 TIMESTAMP = 1518264000000
@@ -54,6 +57,7 @@ class ImportHandlerTest(TestCase):
 
     def setUp(self):
         self.__setup_stub_aws_config()
+        db_connection_manager.close()
         self.__setup_kms()
         self.__setup_db_connection_string()
 
@@ -125,6 +129,143 @@ class ImportHandlerTest(TestCase):
             )
             self.__assert_import_file_has_been_removed_from_s3()
 
+    def test_imports_messages_through_a_staging_table_in_staged_mode(self):
+        self.__setup_s3()
+        self.__setup_db_connection_string(True)
+        os.environ['IMPORT_MODE'] = 'staged'
+        incomplete_event = json.loads(self.__create_event_string('sample-id-4', 'session-id-4'))
+        incomplete_event['document']['details'].pop('minimum_level_of_assurance')
+
+        self.__write_import_file_to_s3(
+            [
+                self.__create_event_string('sample-id-1', 'session-id-1'),
+                self.__create_event_string('sample-id-1', 'session-id-1'),
+                self.__create_event_string('sample-id-2', 'session-id-2'),
+                self.__create_fraud_event_string('sample-id-3', 'session-id-3', 'fraud-event-id-1'),
+                json.dumps(incomplete_event),
+            ]
+        )
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            import_handler.import_events(self.__create_s3_event(), None)
+
+            self.__assert_audit_events_table_has_billing_event_records(
+                [('sample-id-1', 'session-id-1'), ('sample-id-2', 'session-id-2')], MINIMUM_LEVEL_OF_ASSURANCE)
+            self.__assert_audit_events_table_has_fraud_event_records(
+                [('sample-id-3', 'session-id-3', 'fraud-event-id-1')])
+            self.__assert_billing_events_table_has_billing_event_records(['session-id-1', 'session-id-2'])
+            self.__assert_fraud_events_table_has_fraud_event_records([('session-id-3', 'fraud-event-id-1')])
+            log_capture.check(
+                (
+                    'event-recorder',
+                    'INFO',
+                    'Created connection to DB'
+                ),
+                (
+                    'event-recorder',
+                    'ERROR',
+                    'Failed to store messageInvalid Message. Missing required billing details field '
+                    '"minimum_level_of_assurance"'
+                ),
+                (
+                    'event-recorder',
+                    'INFO',
+                    'Imported {0}: 3 inserted, 1 duplicates, 1 rejected'.format(IMPORT_FILE_NAME)
+                )
+            )
+            self.__assert_import_file_has_been_removed_from_s3()
+
+    def test_stores_the_rest_of_a_staged_batch_which_the_database_refuses(self):
+        self.__setup_s3()
+        self.__setup_db_connection_string(True)
+        os.environ['IMPORT_MODE'] = 'staged'
+        # jsonb can't hold the \u0000 escape, so this line maps fine but fails in the database
+        refused_event = json.loads(self.__create_event_string('sample-id-3', 'session-id-3'))
+        refused_event['document']['details']['note'] = 'a\x00b'
+
+        self.__write_import_file_to_s3(
+            [
+                self.__create_event_string('sample-id-1', 'session-id-1'),
+                self.__create_event_string('sample-id-2', 'session-id-2'),
+                json.dumps(refused_event),
+                self.__create_event_string('sample-id-4', 'session-id-4'),
+            ]
+        )
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            import_handler.import_events(self.__create_s3_event(), None)
+
+            self.assertIn(
+                (
+                    'event-recorder',
+                    'ERROR',
+                    'Failed to store the staged batch of lines after line 0 - storing it in smaller batches'
+                ),
+                log_capture.actual()
+            )
+            self.assertIn(
+                (
+                    'event-recorder',
+                    'INFO',
+                    'Imported {0}: 3 inserted, 0 duplicates, 1 rejected'.format(IMPORT_FILE_NAME)
+                ),
+                log_capture.actual()
+            )
+
+        self.__assert_audit_events_table_has_billing_event_records(
+            [('sample-id-1', 'session-id-1'), ('sample-id-2', 'session-id-2'), ('sample-id-4', 'session-id-4')],
+            MINIMUM_LEVEL_OF_ASSURANCE)
+        self.__assert_audit_events_table_does_not_have_event('sample-id-3')
+        self.__assert_billing_events_table_has_billing_event_records(['session-id-1', 'session-id-2', 'session-id-4'])
+        self.__assert_import_file_has_been_removed_from_s3()
+
+    def test_resumes_import_from_the_last_checkpoint(self):
+        self.__setup_s3()
+        self.__setup_db_connection_string(True)
+        first_line = self.__create_event_string('sample-id-1', 'session-id-1')
+        self.__write_import_file_to_s3(
+            [
+                first_line,
+                self.__create_event_string('sample-id-2', 'session-id-2'),
+                self.__create_fraud_event_string('sample-id-3', 'session-id-3', 'fraud-event-id-1'),
+            ]
+        )
+        etag = self.__s3_client.head_object(Bucket=IMPORT_BUCKET_NAME, Key=IMPORT_FILE_NAME)['ETag']
+        earlier_etag = '"an-earlier-version"'
+        with RunInTransaction(self.db_connection) as cursor:
+            write_import_checkpoint(
+                ImportCheckpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, etag, len(first_line) + 1, 1), cursor)
+            write_import_checkpoint(
+                ImportCheckpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, earlier_etag, 100, 2), cursor)
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            import_handler.import_events(self.__create_s3_event(), None)
+
+            self.__assert_audit_events_table_does_not_have_event('sample-id-1')
+            self.__assert_audit_events_table_has_billing_event_records(
+                [('sample-id-2', 'session-id-2')], MINIMUM_LEVEL_OF_ASSURANCE)
+            self.__assert_audit_events_table_has_fraud_event_records(
+                [('sample-id-3', 'session-id-3', 'fraud-event-id-1')])
+            self.assertEqual(
+                read_import_checkpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, etag, self.db_connection),
+                ImportCheckpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, etag))
+            self.assertEqual(
+                read_import_checkpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, earlier_etag, self.db_connection),
+                ImportCheckpoint(IMPORT_BUCKET_NAME, IMPORT_FILE_NAME, earlier_etag))
+            log_capture.check(
+                (
+                    'event-recorder',
+                    'INFO',
+                    'Created connection to DB'
+                ),
+                (
+                    'event-recorder',
+                    'INFO',
+                    'Resuming import of {0} after line 1'.format(IMPORT_FILE_NAME)
+                )
+            )
+            self.__assert_import_file_has_been_removed_from_s3()
+
     def __clean_db(self):
         with RunInTransaction(self.db_connection) as cursor:
             cursor.execute("""
@@ -269,6 +410,20 @@ class ImportHandlerTest(TestCase):
             self.assertEqual(matching_records[5], fraud_event[1])
             self.assertEqual(matching_records[6], GPG45_STATUS)
 
+    def __assert_audit_events_table_does_not_have_event(self, event_id):
+        with RunInTransaction(self.db_connection) as cursor:
+            cursor.execute("""
+                SELECT
+                    *
+                FROM
+                    audit.audit_events
+                WHERE
+                    event_id = %s;
+            """, [event_id])
+            matching_records = cursor.fetchone()
+
+        self.assertIsNone(matching_records)
+
     def __assert_import_file_has_been_removed_from_s3(self):
         s3 = boto3.resource('s3')
         bucket = s3.Bucket(IMPORT_BUCKET_NAME)
@@ -331,6 +486,7 @@ class ImportHandlerTest(TestCase):
             'AWS_ACCESS_KEY_ID': 'AWS_ACCESS_KEY_ID',
             'AWS_SECRET_ACCESS_KEY': 'AWS_SECRET_ACCESS_KEY'
         }
+        reset_clients()
 
     def __create_event_string(self, event_id, session_id):
         return json.dumps({
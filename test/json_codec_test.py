@@ -0,0 +1,56 @@
+import math
+import uuid
+from datetime import datetime
+from json import JSONDecodeError
+from unittest import TestCase
+
+from src import json_codec
+
+DETAILS = {
+    'session_event_type': 'idp_authn_succeeded',
+    'pid': 'a pid',
+    'idp_entity_id': 'https://idp.example.com/£',
+    'levels': [1, 2],
+    'nested': {'big': 2 ** 70, 'none': None},
+}
+DETAILS_JSON = (
+    '{"session_event_type":"idp_authn_succeeded","pid":"a pid","idp_entity_id":"https://idp.example.com/£",'
+    '"levels":[1,2],"nested":{"big":1180591620717411303424,"none":null}}'
+)
+
+
+class JsonCodecTest(TestCase):
+
+    def setUp(self):
+        self.__orjson = json_codec.orjson
+
+    def tearDown(self):
+        json_codec.orjson = self.__orjson
+
+    def test_gives_the_same_output_with_and_without_orjson(self):
+        self.assertEqual(json_codec.dumps(DETAILS), DETAILS_JSON)
+
+        json_codec.orjson = None
+
+        self.assertEqual(json_codec.dumps(DETAILS), DETAILS_JSON)
+
+    def test_writes_and_rejects_what_the_json_module_does_with_and_without_orjson(self):
+        for backend in [self.__orjson, None]:
+            json_codec.orjson = backend
+
+            self.assertEqual(json_codec.dumps({'score': math.nan, 'limit': math.inf}), '{"score":NaN,"limit":Infinity}')
+            self.assertEqual(json_codec.dumps({'large': 1e16, 'small': 1e-07}), '{"large":1e+16,"small":1e-07}')
+            self.assertEqual(json_codec.dumps({1: 'a key which is not a str'}), '{"1":"a key which is not a str"}')
+            for value in [{'time': datetime(2019, 8, 5, 11, 54)}, {'id': uuid.uuid4()}]:
+                with self.assertRaises(TypeError):
+                    json_codec.dumps(value)
+
+    def test_reads_what_the_json_module_reads(self):
+        for backend in [self.__orjson, None]:
+            json_codec.orjson = backend
+
+            self.assertEqual(json_codec.loads(DETAILS_JSON), DETAILS)
+            self.assertEqual(json_codec.loads(DETAILS_JSON.encode('utf-8')), DETAILS)
+            self.assertTrue(math.isnan(json_codec.loads('{"score": NaN}')['score']))
+            with self.assertRaises(JSONDecodeError):
+                json_codec.loads('not valid')
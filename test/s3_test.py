@@ -0,0 +1,48 @@
+import csv
+import io
+from unittest import TestCase
+
+from src.s3 import StreamingBodyReader, iter_lines_with_offsets
+
+
+class StubStreamingBody(object):
+    def __init__(self, content, max_read_size):
+        self.__content = content
+        self.__max_read_size = max_read_size
+        self.closed = False
+
+    def read(self, amt=None):
+        size = min(amt, self.__max_read_size)
+        data, self.__content = self.__content[:size], self.__content[size:]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+class StreamingBodyReaderTest(TestCase):
+
+    def test_reads_csv_rows_split_across_reads(self):
+        body = StubStreamingBody('a,"multi\r\nline",é€\r\nb,c,d\re,f,g\n'.encode('utf-8'), max_read_size=3)
+
+        with io.TextIOWrapper(io.BufferedReader(StreamingBodyReader(body), 4), encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+
+        self.assertEqual(rows, [['a', 'multi\r\nline', 'é€'], ['b', 'c', 'd'], ['e', 'f', 'g']])
+        self.assertTrue(body.closed)
+
+
+class IterLinesWithOffsetsTest(TestCase):
+
+    def test_splits_lines_across_reads_and_tracks_where_the_next_line_starts(self):
+        content = b'ab\r\ncd\n\nef\rgh'
+
+        for read_size in [1, 2, 3, 100]:
+            lines = list(iter_lines_with_offsets(StubStreamingBody(content, read_size), chunk_size=read_size))
+
+            self.assertEqual(lines, [(b'ab', 4), (b'cd', 7), (b'', 8), (b'ef', 11), (b'gh', 13)], read_size)
+
+    def test_counts_offsets_from_the_start_of_a_ranged_read(self):
+        body = StubStreamingBody(b'cd\nef\n', 100)
+
+        self.assertEqual(list(iter_lines_with_offsets(body, 4)), [(b'cd', 7), (b'ef', 10)])
@@ -0,0 +1,214 @@
+from unittest import TestCase
+
+from testfixtures import LogCapture
+
+from src.sqs import MessageDeleter, PrefetchingReceiver, release_messages
+
+QUEUE_URL = 'https://sqs.eu-west-2.amazonaws.com/123456789012/event-queue'
+
+
+class StubSqsClient(object):
+    def __init__(self, failures_per_call=(), batches=(), sender_fault_handles=(), delete_error=None):
+        self.delete_message_batch_calls = []
+        self.received_batches = []
+        self.change_message_visibility_batch_calls = []
+        self.__failures_per_call = list(failures_per_call)
+        self.__batches = list(batches)
+        self.__sender_fault_handles = list(sender_fault_handles)
+        self.__delete_error = delete_error
+
+    def change_message_visibility_batch(self, QueueUrl, Entries):
+        self.change_message_visibility_batch_calls.append(
+            [(entry['ReceiptHandle'], entry['VisibilityTimeout']) for entry in Entries])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries]}
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages, VisibilityTimeout, WaitTimeSeconds):
+        batch = self.__batches.pop(0) if self.__batches else []
+        self.received_batches.append(batch)
+        return {'Messages': batch} if batch else {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self.delete_message_batch_calls.append([entry['ReceiptHandle'] for entry in Entries])
+        if self.__delete_error is not None:
+            raise self.__delete_error
+        failing_handles = self.__failures_per_call.pop(0) if self.__failures_per_call else []
+        return {
+            'Successful': [
+                {'Id': entry['Id']} for entry in Entries
+                if entry['ReceiptHandle'] not in failing_handles + self.__sender_fault_handles
+            ],
+            'Failed': [
+                {'Id': entry['Id'], 'SenderFault': False, 'Code': 'InternalError', 'Message': 'try again'}
+                for entry in Entries if entry['ReceiptHandle'] in failing_handles
+            ] + [
+                {'Id': entry['Id'], 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid', 'Message': 'bad handle'}
+                for entry in Entries if entry['ReceiptHandle'] in self.__sender_fault_handles
+            ],
+        }
+
+
+class StubContext(object):
+    def __init__(self, remaining_time_in_millis):
+        self.__remaining_time_in_millis = remaining_time_in_millis
+
+    def get_remaining_time_in_millis(self):
+        return self.__remaining_time_in_millis
+
+
+def message(number):
+    return {'MessageId': 'message-id-{0}'.format(number), 'ReceiptHandle': 'handle-{0}'.format(number)}
+
+
+class MessageDeleterTest(TestCase):
+
+    def test_deletes_messages_in_batches_of_ten(self):
+        sqs_client = StubSqsClient()
+
+        with LogCapture('event-recorder', propagate=False):
+            with MessageDeleter(sqs_client, QUEUE_URL) as message_deleter:
+                for number in range(12):
+                    message_deleter.add(message(number), 'event-id-{0}'.format(number))
+
+        self.assertEqual(
+            sqs_client.delete_message_batch_calls,
+            [['handle-{0}'.format(number) for number in range(10)], ['handle-10', 'handle-11']]
+        )
+
+    def test_retries_only_the_entries_which_failed(self):
+        sqs_client = StubSqsClient(failures_per_call=[['handle-1']])
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            message_deleter = MessageDeleter(sqs_client, QUEUE_URL)
+            for number in range(3):
+                message_deleter.add(message(number), 'event-id-{0}'.format(number))
+            message_deleter.flush()
+
+            log_capture.check(
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: event-id-0'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: event-id-2'),
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: event-id-1'),
+            )
+
+        self.assertEqual(sqs_client.delete_message_batch_calls, [['handle-0', 'handle-1', 'handle-2'], ['handle-1']])
+
+    def test_logs_entries_which_could_not_be_deleted(self):
+        sqs_client = StubSqsClient(failures_per_call=[['handle-0']] * 3)
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            with MessageDeleter(sqs_client, QUEUE_URL) as message_deleter:
+                message_deleter.add(message(0), 'event-id-0')
+
+            log_capture.check(
+                ('event-recorder', 'WARNING',
+                    'Failed to delete event event-id-0 from queue, SQS message ID message-id-0: try again'),
+            )
+
+        self.assertEqual(len(sqs_client.delete_message_batch_calls), 3)
+
+    def test_does_not_retry_entries_which_failed_through_a_fault_in_the_request(self):
+        sqs_client = StubSqsClient(sender_fault_handles=['handle-0'])
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            with MessageDeleter(sqs_client, QUEUE_URL) as message_deleter:
+                message_deleter.add(message(0), 'event-id-0')
+                message_deleter.add(message(1), 'event-id-1')
+
+            log_capture.check(
+                ('event-recorder', 'INFO', 'Deleted event from queue with ID: event-id-1'),
+                ('event-recorder', 'WARNING',
+                    'Failed to delete event event-id-0 from queue, SQS message ID message-id-0: bad handle'),
+            )
+
+        self.assertEqual(sqs_client.delete_message_batch_calls, [['handle-0', 'handle-1']])
+
+    def test_logs_an_error_from_the_client_without_raising_it(self):
+        sqs_client = StubSqsClient(delete_error=RuntimeError('throttled'))
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            with MessageDeleter(sqs_client, QUEUE_URL) as message_deleter:
+                for number in range(11):
+                    message_deleter.add(message(number), 'event-id-{0}'.format(number))
+
+            log_capture.check(*[
+                ('event-recorder', 'ERROR', 'Failed to delete a batch of 10 events from queue'),
+            ] + [
+                ('event-recorder', 'WARNING',
+                    'Failed to delete event event-id-{0} from queue, SQS message ID message-id-{0}: throttled'.format(
+                        number))
+                for number in range(10)
+            ] + [
+                ('event-recorder', 'ERROR', 'Failed to delete a batch of 1 events from queue'),
+                ('event-recorder', 'WARNING',
+                    'Failed to delete event event-id-10 from queue, SQS message ID message-id-10: throttled'),
+            ])
+
+        self.assertEqual(len(sqs_client.delete_message_batch_calls), 2)
+
+    def test_flushes_immediately_when_close_to_the_deadline(self):
+        sqs_client = StubSqsClient()
+
+        with LogCapture('event-recorder', propagate=False):
+            message_deleter = MessageDeleter(sqs_client, QUEUE_URL, StubContext(remaining_time_in_millis=1000))
+            message_deleter.add(message(0), 'event-id-0')
+
+        self.assertEqual(sqs_client.delete_message_batch_calls, [['handle-0']])
+
+
+class PrefetchingReceiverTest(TestCase):
+
+    def test_yields_messages_from_every_batch_in_order(self):
+        sqs_client = StubSqsClient(batches=[[message(0), message(1)], [message(2)]])
+
+        with PrefetchingReceiver(sqs_client, QUEUE_URL) as receiver:
+            messages = list(receiver)
+
+        self.assertEqual(messages, [message(0), message(1), message(2)])
+        self.assertEqual(len(sqs_client.received_batches), 3)
+
+    def test_receives_each_batch_only_when_needed_without_prefetch(self):
+        sqs_client = StubSqsClient(batches=[[message(0)], [message(1)]])
+
+        with PrefetchingReceiver(sqs_client, QUEUE_URL, prefetch_depth=0) as receiver:
+            messages = iter(receiver)
+            self.assertEqual(next(messages), message(0))
+            self.assertEqual(len(sqs_client.received_batches), 1)
+            self.assertEqual(list(messages), [message(1)])
+
+    def test_close_returns_messages_which_were_received_but_not_yielded(self):
+        sqs_client = StubSqsClient(batches=[[message(0)], [message(1), message(2)], [message(3)]])
+
+        receiver = PrefetchingReceiver(sqs_client, QUEUE_URL, prefetch_depth=1)
+        self.assertEqual(next(iter(receiver)), message(0))
+        unprocessed = receiver.close()
+
+        received = [m for batch in sqs_client.received_batches for m in batch]
+        self.assertEqual(unprocessed, received[1:])
+        self.assertLessEqual(len(sqs_client.received_batches), 2)
+
+    def test_close_returns_the_rest_of_a_batch_which_was_partly_yielded(self):
+        sqs_client = StubSqsClient(batches=[[message(0), message(1), message(2)]])
+
+        receiver = PrefetchingReceiver(sqs_client, QUEUE_URL, prefetch_depth=0)
+        self.assertEqual(next(iter(receiver)), message(0))
+
+        self.assertEqual(receiver.close(), [message(1), message(2)])
+
+
+class ReleaseMessagesTest(TestCase):
+
+    def test_makes_messages_visible_again_in_batches_of_ten(self):
+        sqs_client = StubSqsClient()
+
+        release_messages(sqs_client, QUEUE_URL, [message(number) for number in range(11)])
+
+        self.assertEqual(
+            sqs_client.change_message_visibility_batch_calls,
+            [[('handle-{0}'.format(number), 0) for number in range(10)], [('handle-10', 0)]]
+        )
+
+    def test_does_not_call_sqs_when_there_is_nothing_to_release(self):
+        sqs_client = StubSqsClient()
+
+        release_messages(sqs_client, QUEUE_URL, [])
+
+        self.assertEqual(sqs_client.change_message_visibility_batch_calls, [])
@@ -0,0 +1,44 @@
+from datetime import datetime
+from unittest import TestCase
+
+import dateparser
+
+from src.timestamp_parser import UploadTimestampParser
+
+TIMEZONE = 'Europe/London'
+
+
+class UploadTimestampParserTest(TestCase):
+
+    def test_detected_format_gives_the_same_timestamps_as_dateparser(self):
+        uploads = [
+            ['05/08/2019 11:54', '17/08/2019 16:37', '10/08/2019 09:24', '31/12/2019 23:59'],
+            ['08/05/2019 11:54', '08/17/2019 16:37', '08/10/2019 09:24', '12/31/2019 23:59'],
+            ['2019-03-01T02:40:40.1110000Z', '2019-06-01T03:30:30.2220000Z', '2019-01-31T16:26:03+01:00'],
+            ['2019-03-01 02:40:40', '2019-06-01 03:30:30'],
+        ]
+
+        for timestamps in uploads:
+            parser = UploadTimestampParser(TIMEZONE)
+            parser.detect_format(timestamps)
+
+            for timestamp in timestamps:
+                expected = dateparser.parse(timestamp, settings={'TIMEZONE': TIMEZONE})
+                self.assertEqual(with_awareness(parser.parse(timestamp)), with_awareness(expected), timestamp)
+
+    def test_falls_back_to_dateparser_for_a_row_in_another_format(self):
+        parser = UploadTimestampParser(TIMEZONE)
+        parser.detect_format(['2019-03-01 02:40:40', '2019-06-01 03:30:30'])
+
+        self.assertEqual(parser.parse('1 March 2019 02:40'), datetime(2019, 3, 1, 2, 40))
+
+    def test_uses_the_given_format(self):
+        parser = UploadTimestampParser(TIMEZONE, '%Y%m%d %H%M')
+        parser.detect_format(['20190805 1154'])
+
+        self.assertEqual(parser.parse('20190805 1154'), datetime(2019, 8, 5, 11, 54))
+
+
+def with_awareness(date_time):
+    # Naive and aware datetimes never compare equal, but make the difference clear when a test fails
+    return date_time, date_time is not None and date_time.tzinfo is not None
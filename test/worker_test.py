@@ -0,0 +1,72 @@
+import os
+from unittest import TestCase
+
+from testfixtures import LogCapture
+
+from src.worker import ShutdownContext, run_worker
+
+
+class StubShutdownContext(ShutdownContext):
+    def __init__(self):
+        super().__init__()
+        self.waits = []
+
+    def wait(self, seconds):
+        self.waits.append(seconds)
+        return self.is_stopping()
+
+
+class StubDrain(object):
+    def __init__(self, context, outcomes):
+        self.__context = context
+        self.__outcomes = list(outcomes)
+        self.calls = []
+
+    def __call__(self, context, wait_time_seconds):
+        self.calls.append(wait_time_seconds)
+        outcome = self.__outcomes.pop(0)
+        if not self.__outcomes:
+            self.__context.stop()
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+class WorkerTest(TestCase):
+
+    def setUp(self):
+        os.environ = {}
+
+    def test_backs_off_exponentially_while_the_queue_is_empty(self):
+        os.environ['WORKER_MAX_IDLE_BACKOFF_SECONDS'] = '3'
+        context = StubShutdownContext()
+        drain = StubDrain(context, [0, 0, 5, 0, 0, 0])
+
+        with LogCapture('event-recorder', propagate=False):
+            run_worker(context, drain)
+
+        self.assertEqual(drain.calls, [20] * 6)
+        self.assertEqual(context.waits, [1, 2, 1, 2, 3])
+
+    def test_keeps_running_after_a_drain_fails(self):
+        context = StubShutdownContext()
+        drain = StubDrain(context, [RuntimeError('database is down'), 2])
+
+        with LogCapture('event-recorder', propagate=False) as log_capture:
+            run_worker(context, drain)
+
+            log_capture.check(
+                ('event-recorder', 'ERROR', 'Failed to drain queue'),
+                ('event-recorder', 'INFO', 'Worker stopped'),
+            )
+
+        self.assertEqual(context.waits, [1])
+
+    def test_reports_no_time_remaining_once_stopped(self):
+        context = ShutdownContext()
+        self.assertGreater(context.get_remaining_time_in_millis(), 0)
+
+        context.stop()
+
+        self.assertEqual(context.get_remaining_time_in_millis(), 0)
+        self.assertTrue(context.wait(60))